@@ -0,0 +1,638 @@
+#!/usr/bin/python
+
+"""Timing benchmarks for the FITS header and time handling code.
+
+   Written by Andrew Williams, Perth Observatory
+   <andrew@physics.uwa.edu.au>
+"""
+
+version = "$Revision$"
+
+import os
+import sys
+import time
+import array
+import random
+import shutil
+import string
+import platform
+import tempfile
+
+import fits
+import coords
+import parseing
+import fitstime
+
+
+usage = """FITS time code benchmarks - Andrew Williams
+usage:  benchmark [-h|-help|--help]  OR
+        benchmark [-nNUMBER] [filename] [filename] ...
+        benchmark -parse [-nNUMBER] [filename] [filename] ...
+        benchmark -coords [-nNUMBER]
+        benchmark -table [-nNUMBER]
+        benchmark -header [-nNUMBER]
+        benchmark -suite [-json] [-nNUMBER] [-sSITE] [-sSITE] ...
+
+Times reading the FITS header of each of the given files, comparing
+the block-at-a-time header reader used by fits.FITS with the old
+card-at-a-time reader. The -n option gives the number of times to
+read each file (default 200), eg 'benchmark -n1000 *.fits'.
+
+With -parse, times parseing.parseheader on the header of each file
+instead, NUMBER times (default 2000).
+
+With -coords, compares the scalar and vectorized (numpy) versions of
+coords.juldate, caldate, precess, hjd and bjd, for NUMBER random epochs
+and coordinates (default 100000). 'hjd-month' times hjd for one object
+and epochs from a single month, where the cached precession matrices
+are reused.
+
+With -table, an ASCII table extension with NUMBER rows (default 100000)
+is generated, and reading it with fits.FITS in tmode 'list' (one row at a
+time) is compared with tmode 'columns' (vectorized, with numpy).
+
+With -header, the header of an image with NUMBER HISTORY lines (default
+5000), plus COMMENT, HIERARCH and the usual cards, is encoded by fits._header
+as it is in FITS.save, and compared with the old card-by-card encoder. The
+order of the cards written by FITS.update to a 3-axis image and a BINTABLE
+extension is checked first.
+
+With -suite, synthetic FITS files are generated in a temporary directory,
+one for each header style in the 'sites' table below (eg DATE-OBS with a
+'T' time part, UTDATE and UT-START, TM_START in seconds, MJD-OBS only, or
+an ESO header with hundreds of HIERARCH cards). For each file, these are
+timed separately: fits._parseline (per card), fits.FITS in mode 'h' and
+'r', parseing.parseheader, fitstime.findtime, coords.hjd and FITS.save.
+Each operation is timed NUMBER times (default 200), and the operations per
+second and the percentiles of the time per operation are printed. With
+-json, the results are printed as a JSON document instead of a table, to
+keep for comparison with later runs. Use -sSITE to run only the named
+site/s.
+"""
+
+
+#Header cards for each style of synthetic file generated by the -suite option,
+#as (key, value, comment) tuples. Values are given exactly as they appear in
+#the card, so strings include their quotes. Every file also gets the SIMPLE,
+#BITPIX and NAXIS cards, BSCALE and BZERO, and any HIERARCH or HISTORY cards
+#given in the 'extras' dictionary.
+
+sites = [
+  ('dateobs-T', [('DATE-OBS', "'2003-06-24T06:19:12.50'", 'UT start of exposure'),
+                 ('EXPTIME', '300.0', 'seconds'),
+                 ('RA', "'17:57:00.0'", None),
+                 ('DEC', "'-28:30:00'", None),
+                 ('EQUINOX', '2000.0', None),
+                 ('OBJECT', "'OB03208'", None),
+                 ('TELESCOP', "'Danish 1.54m'", None)]),
+  ('utdate-utstart', [('UTDATE', "'2003-06-24'", None),
+                      ('UT-START', "'06:19:12'", None),
+                      ('EXPOSURE', '120.0', None),
+                      ('RA_OBJ', '269.25', 'degrees'),
+                      ('DEC_OBJ', '-28.5', 'degrees'),
+                      ('TELESCOP', "'CTIO 0.9m'", None)]),
+  ('tm-start', [('DATE-OBS', "'24/06/03'", 'dd/mm/yy'),
+                ('TM_START', '22752.0', 'seconds after midnight UT'),
+                ('TM_END', '23052.0', None),
+                ('ITIME', '300.0', None),
+                ('RA', "'17:57:00.0'", None),
+                ('DEC', "'-28:30:00'", None),
+                ('EPOCH', '2000.0', None),
+                ('TELESCOP', "'Perth 0.6m'", None)]),
+  ('mjd-only', [('MJD-OBS', '52814.263338', 'MJD at start'),
+                ('EXPTIME', '60.0', None),
+                ('TELESCOP', "'Robotic'", None)]),
+  ('jd-hjd', [('DATE', "'2003-06-24T06:19:12'", None),
+              ('JD', '2452814.763338', None),
+              ('HJD', '2452814.770910', None),
+              ('EXPTIME', '300.0', None),
+              ('RA', '17.95', 'hours'),
+              ('DEC', '-28.5', None)]),
+  ('utc-obs', [('DATE-OBS', "'2003-06-24'", None),
+               ('UTC-OBS', "'06:19:12.5'", None),
+               ('MJD', '52814.263338', None),
+               ('EXPTIME', '30.0', None),
+               ('RA', "'17 57 00.0'", None),
+               ('DEC', "'-28 30 00'", None)]),
+  ('eso-hierarch', [('DATE-OBS', "'2003-06-24T06:19:12.500'", None),
+                    ('MJD-OBS', '52814.26333912', None),
+                    ('EXPTIME', '300.0', None),
+                    ('RA', '269.25', 'degrees'),
+                    ('DEC', '-28.5', 'degrees'),
+                    ('EQUINOX', '2000.', None),
+                    ('TELESCOP', "'ESO-VLT-U1'", None),
+                    ('INSTRUME', "'FORS2'", None)]),
+  ]
+
+extras = {'eso-hierarch':{'HIERARCH':400, 'HISTORY':20},
+          'tm-start':{'HISTORY':100}}
+
+
+class _Header:
+  pass          #Holds the headers and comments dictionaries for _parseline
+
+
+def cardheader(fname):
+  """Read the header the old way, with one 80-byte read and one _parseline call
+     per card, for comparison with the block reader.
+  """
+  ob = _Header()
+  ob.headers = {}
+  ob.comments = {}
+  f = open(fname, 'r')
+  finished = 0
+  while not finished:
+    finished = fits._parseline(ob, f.read(80))
+  f.close()
+  return ob
+
+
+def oldfh(fim, h):
+  """Format one header card the old way, with the string module functions
+     and repeated concatenation, for comparison with fits._fh.
+  """
+  h=string.upper(h)
+  try:
+    if h=='END':
+      return string.ljust('END',80)
+    elif h == 'COMMENT' or h == 'HISTORY':
+      lines=string.split(fim.comments[h],'\n')
+      out=''
+      for l in lines:
+        out = out + string.ljust(string.ljust(h,8)+l, 80)[:80]
+      return out
+    elif h == 'HIERARCH':
+      lines=string.split(fim.comments[h],'\n')
+      out=''
+      for l in lines:
+        out = out + string.ljust('HIERARCH '+l, 80)[:80]
+      return out
+    elif h not in fim.headers.keys():
+      return ''
+    else:
+      v=fim.headers[h]
+      v=" ".join(v.split('\n'))
+      if v=="":
+        return string.ljust(h,80)[:80]
+      out = string.ljust(h,8)[:8] + '= '
+      if v[0]=='"' or v[0]=="'":
+        out=out+string.ljust(v,20)
+      else:
+        out=out+string.rjust(v,20)
+      if fim.comments.has_key(h):
+        cm = " ".join(fim.comments[h].split('\n'))
+        out=out+' / '+cm
+      out=string.ljust(out,80)
+      if len(out)>80:
+        out=out[:80]
+    return out
+  except KeyError:
+    return ''
+
+
+def oldheader(fim):
+  """Encode the header of fim the old way, one oldfh call per card."""
+  out = []
+  for h in fits.hfirst:
+    out.append(oldfh(fim, h))
+  tmplist = fim.headers.keys()
+  tmplist.sort()
+  for h in tmplist:
+    if (h not in fits.hfirst) and (h not in fits.hlast):
+      out.append(oldfh(fim, h))
+  for h in fits.hlast:
+    out.append(oldfh(fim, h))
+  return ''.join(out)
+
+
+def bench_encode(n=5000):
+  """Compare the old and new header encoders on a header with n HISTORY lines."""
+  random.seed(1)
+  fim = fits.FITS('', 'h')
+  for site,cl in sites:
+    for key,value,comment in cl:
+      fim.headers[key] = value
+      if comment:
+        fim.comments[key] = comment
+  for i in xrange(200):
+    fim.headers['KEY%04d' % i] = '%.6f' % random.random()
+    fim.comments['KEY%04d' % i] = 'synthetic card %d' % i
+  fim.comments['HIERARCH'] = '\n'.join(['ESO DET CHIP%d PAR%d = %14.6f' % (i/40+1, i%40, random.random())
+                                        for i in xrange(100)])
+  fim.comments['HISTORY'] = '\n'.join([' synthetic history line %d' % i for i in xrange(n)])
+  assert fits._header(fim) == oldheader(fim), "Header mismatch"
+  check_update()
+  told = timeit(oldheader, (fim,), 20)
+  tnew = timeit(fits._header, (fim,), 20)
+  print "%-10s %8s %8s %12s %12s %9s" % ('Header', 'History', 'Cards', 'old(ms)', 'new(ms)', 'Speedup')
+  print "%-10s %8d %8d %12.3f %12.3f %9.1f" % ('synthetic', n, len(fits._header(fim))/80,
+                                               told*1e3, tnew*1e3, told/tnew)
+
+
+def cardkeys(fname, offset=0):
+  """Return the list of keys of the header cards starting at 'offset' in the
+     file, in the order they are in the file, up to the END card.
+  """
+  f = open(fname, 'rb')
+  f.seek(offset)
+  keys = []
+  while 'END' not in keys:
+    block = f.read(2880)
+    if not block:
+      break
+    keys = keys + [block[i:i+8].strip() for i in xrange(0, len(block), 80)]
+  f.close()
+  return keys[:keys.index('END')]
+
+
+def check_update():
+  """Add a card with FITS.update to a 3-axis image, and to a BINTABLE extension,
+     and check that the cards required by the FITS standard are still first,
+     in order, when the headers are read back.
+  """
+  tmpdir = tempfile.mkdtemp(prefix='fitsbench')
+  try:
+    cube = os.path.join(tmpdir, 'cube.fits')
+    h = ''.join([card('SIMPLE', 'T'), card('BITPIX', '16'), card('NAXIS', '3'),
+                 card('NAXIS1', '4'), card('NAXIS2', '3'), card('NAXIS3', '2'),
+                 card('OBJECT', "'cube'"), card('END')])
+    f = open(cube, 'wb')
+    f.write(h + ' '*(-len(h) % 2880) + '\0'*2880)
+    f.close()
+    fim = fits.FITS(cube, 'h')
+    fim.headers['MJD-OBS'] = '52814.2633'
+    assert fim.update(), "Can't update "+cube
+    keys = cardkeys(cube)
+    assert keys[:6] == ['SIMPLE', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'NAXIS3'], keys
+    assert 'MJD-OBS' in keys, keys
+
+    table = os.path.join(tmpdir, 'table.fits')
+    h = ''.join([card('SIMPLE', 'T'), card('BITPIX', '8'), card('NAXIS', '0'),
+                 card('EXTEND', 'T'), card('END')])
+    t = ''.join([card('XTENSION', "'BINTABLE'"), card('BITPIX', '8'), card('NAXIS', '2'),
+                 card('NAXIS1', '12'), card('NAXIS2', '2'), card('PCOUNT', '0'),
+                 card('GCOUNT', '1'), card('TFIELDS', '2'),
+                 card('TTYPE1', "'ID'"), card('TFORM1', "'J'"),
+                 card('TTYPE2', "'JD'"), card('TFORM2', "'D'"),
+                 card('EXTNAME', "'EVENTS'"), card('END')])
+    f = open(table, 'wb')
+    f.write(h + ' '*(-len(h) % 2880) + t + ' '*(-len(t) % 2880) + '\0'*2880)
+    f.close()
+    fim = fits.FITS(table, 'h', ext='EVENTS')
+    fim.headers['PHJDMID'] = '2452814.77091'
+    assert fim.update(), "Can't update "+table
+    keys = cardkeys(table, fits.hduindex(table)[1].hdroffset)
+    assert keys[:8] == ['XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2',
+                        'PCOUNT', 'GCOUNT', 'TFIELDS'], keys
+    assert 'PHJDMID' in keys, keys
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def blockheader(fname, nblocks=None):
+  """Read the header using the block reader, fits._readheader."""
+  ob = _Header()
+  ob.headers = {}
+  ob.comments = {}
+  f = open(fname, 'r')
+  fits._readheader(ob, f, nblocks)
+  f.close()
+  return ob
+
+
+def timeit(func, args=(), n=200):
+  """Call func(*args) n times, and return the mean time per call, in seconds."""
+  t0 = time.time()
+  for i in xrange(n):
+    func(*args)
+  return (time.time()-t0)/n
+
+
+def bench_headers(files, n=200):
+  """Compare card-at-a-time and block header reads for each file."""
+  print "%-30s %6s %10s %10s %10s %7s" % ('File', 'Keys', 'card(us)',
+                                           'block(us)', '4block(us)', 'Speedup')
+  for fname in files:
+    ob = blockheader(fname)
+    assert ob.headers == cardheader(fname).headers, "Header mismatch in "+fname
+    tc = timeit(cardheader, (fname,), n)
+    tb = timeit(blockheader, (fname,), n)
+    t4 = timeit(blockheader, (fname, 4), n)
+    print "%-30s %6d %10.1f %10.1f %10.1f %7.2f" % (fname[-30:], len(ob.headers), tc*1e6,
+                                                     tb*1e6, t4*1e6, tc/tb)
+
+
+def bench_parse(files, n=2000):
+  """Time parseing.parseheader on the headers of each file."""
+  print "%-30s %6s %12s" % ('File', 'Keys', 'parse(us)')
+  total = 0.0
+  for fname in files:
+    f = fits.FITS(fname, 'h')
+    yg = fitstime.yearfromheaders(f.headers)
+    stdout = sys.stdout
+    sys.stdout = open('/dev/null', 'w')    #Hide any parse warnings
+    try:
+      t = timeit(parseing.parseheader, (f.headers, f.comments, yg), n)
+    finally:
+      sys.stdout = stdout
+    total = total + t
+    print "%-30s %6d %12.1f" % (fname[-30:], len(f.headers), t*1e6)
+  print "%-30s %6s %12.1f" % ('Mean', '', total/len(files)*1e6)
+
+
+def bench_coords(n=100000):
+  """Compare the scalar functions in coords with the vectorized versions, for
+     n random epochs (1995-2020) and coordinates.
+  """
+  if not coords.Gotnumpy:
+    print "No numpy library, can't test vectorized coords functions."
+    return
+  import numpy
+  jd = numpy.array([2449718.5 + random.random()*9131 for i in xrange(n)])
+  ra = numpy.array([random.random()*360.0 for i in xrange(n)])
+  dec = numpy.array([random.random()*180.0-90.0 for i in xrange(n)])
+  ymd = [coords.caldate(j) for j in jd]
+  y = numpy.array([d[0] for d in ymd])
+  m = numpy.array([d[1] for d in ymd])
+  d = numpy.array([int(d[2]) for d in ymd])
+  jm = jd[0] + 30.0*numpy.random.random(n)        #Epochs from one month of observations
+
+  tests = [('juldate', lambda: [coords.juldate(data=(y[i],m[i],d[i],12,30,15.5,0,0,0)) for i in xrange(n)],
+                       lambda: coords.vjuldate(y,m,d,12,30,15.5)),
+           ('caldate', lambda: [coords.caldate(j)[2] for j in jd],
+                       lambda: coords.vcaldate(jd)[2]),
+           ('precess', lambda: [coords.precess(2433282.5,jd[i],ra[i],dec[i])[0] for i in xrange(n)],
+                       lambda: coords.vprecess(2433282.5,jd,ra,dec)[0]),
+           ('hjd',     lambda: [coords.hjd(jd[i],ra[i],dec[i]) for i in xrange(n)],
+                       lambda: coords.vhjd(jd,ra,dec)),
+           ('hjd-month', lambda: [coords.hjd(jm[i],ra[0],dec[0]) for i in xrange(n)],
+                         lambda: coords.vhjd(jm,ra[0],dec[0])),
+           ('bjd',     lambda: [coords.bjd(jd[i],ra[i],dec[i]) for i in xrange(n)],
+                       lambda: coords.vbjd(jd,ra,dec))]
+
+  worst = coords.checkephem()     #Raises ValueError if out of tolerance
+  print "Ephemeris %s: largest difference from the reference positions %.3g AU" % (coords.ephemfile, worst)
+  print
+  print "%-10s %8s %12s %12s %9s %10s" % ('Function', 'N', 'scalar(s)', 'vector(s)',
+                                           'Speedup', 'MaxDiff')
+  for name,sfunc,vfunc in tests:
+    t0 = time.time()
+    sv = numpy.array(sfunc())
+    t1 = time.time()
+    vv = vfunc()
+    t2 = time.time()
+    print "%-10s %8d %12.4f %12.4f %9.1f %10.3g" % (name, n, t1-t0, t2-t1,
+                                                     (t1-t0)/(t2-t1), abs(sv-vv).max())
+
+
+def tablefile(fname, nrows=100000):
+  """Write a FITS file 'fname' with no primary data, and an ASCII table
+     extension of nrows rows, with a string, an integer and two float fields.
+  """
+  h = ''.join([card('SIMPLE', 'T'), card('BITPIX', '8'), card('NAXIS', '0'),
+               card('EXTEND', 'T'), card('END')])
+  h = h + ' '*(-len(h) % 2880)
+  t = ''.join([card('XTENSION', "'TABLE'"), card('BITPIX', '8'), card('NAXIS', '2'),
+               card('NAXIS1', '42'), card('NAXIS2', str(nrows)), card('PCOUNT', '0'),
+               card('GCOUNT', '1'), card('TFIELDS', '4'),
+               card('TTYPE1', "'NAME'"), card('TBCOL1', '1'), card('TFORM1', "'A10'"),
+               card('TTYPE2', "'ID'"), card('TBCOL2', '11'), card('TFORM2', "'I8'"),
+               card('TTYPE3', "'MAG'"), card('TBCOL3', '19'), card('TFORM3', "'F10.4'"),
+               card('TTYPE4', "'JD'"), card('TBCOL4', '29'), card('TFORM4', "'E14.7'"),
+               card('END')])
+  t = t + ' '*(-len(t) % 2880)
+  rows = []
+  for i in xrange(nrows):
+    rows.append('star%-6d%8d%10.4f%14.7e' % (i, i, random.random()*20, 2452814.5+random.random()))
+  d = ''.join(rows)
+  f = open(fname, 'wb')
+  f.write(h + t + d + ' '*(-len(d) % 2880))
+  f.close()
+
+
+def bench_table(n=100000):
+  """Compare reading an ASCII table of n rows one row at a time (tmode 'list')
+     with the vectorized column reader (tmode 'columns').
+  """
+  random.seed(1)
+  tmpdir = tempfile.mkdtemp(prefix='fitsbench')
+  try:
+    fname = os.path.join(tmpdir, 'table.fits')
+    tablefile(fname, n)
+    t0 = time.time()
+    rows = fits.FITS(fname, 'r', tmode='list').table
+    t1 = time.time()
+    cols = fits.FITS(fname, 'r', tmode='columns').table
+    t2 = time.time()
+  finally:
+    shutil.rmtree(tmpdir)
+  for i in range(len(cols.fields)):
+    c = [r[i] for r in rows.data]
+    assert list(cols.data[cols.fields[i][0]]) == c, "Column mismatch in "+cols.fields[i][0]
+  print "%-10s %8s %12s %12s %9s" % ('Table', 'Rows', 'list(s)', 'columns(s)', 'Speedup')
+  print "%-10s %8d %12.4f %12.4f %9.1f" % ('ascii', n, t1-t0, t2-t1, (t1-t0)/(t2-t1))
+
+
+def card(key, value=None, comment=None):
+  """Return an 80-character FITS card, with the value right justified in
+     columns 11-30 (or left justified, if it's a string), and the comment
+     after a '/'. If value is None, the comment follows the key directly, as
+     for HISTORY cards.
+  """
+  if value is None:
+    return (key.ljust(8) + (comment or ''))[:80].ljust(80)
+  if value[0] == "'":
+    s = key.ljust(8) + '= ' + value.ljust(20)
+  else:
+    s = key.ljust(8) + '= ' + value.rjust(20)
+  if comment:
+    s = s + ' / ' + comment
+  return s[:80].ljust(80)
+
+
+def synthfile(fname, site, shape=(256,256)):
+  """Write a synthetic 16-bit FITS file 'fname', with the header style given
+     by the site name (see the 'sites' table), and random pixel values.
+  """
+  cards = [card('SIMPLE', 'T'), card('BITPIX', '16'), card('NAXIS', '2'),
+           card('NAXIS1', str(shape[1])), card('NAXIS2', str(shape[0]))]
+  for key,value,comment in dict(sites)[site]:
+    cards.append(card(key, value, comment))
+  ex = extras.get(site, {})
+  for i in xrange(ex.get('HIERARCH', 0)):
+    cards.append(card('HIERARCH', None, 'ESO DET CHIP%d PAR%d = %14.6f / synthetic' %
+                                        (i/40+1, i%40, random.random()*1000)))
+  for i in xrange(ex.get('HISTORY', 0)):
+    cards.append(card('HISTORY', None, ' synthetic history line %d' % i))
+  cards = cards + [card('BSCALE', '1.0'), card('BZERO', '32768.0'), card('END')]
+  h = ''.join(cards)
+  h = h + ' '*(-len(h) % 2880)
+  d = array.array('h', [random.randint(-32768, 32767) for i in xrange(shape[0]*shape[1])])
+  if sys.byteorder == 'little':
+    d.byteswap()
+  d = d.tostring()
+  f = open(fname, 'wb')
+  f.write(h + d + '\0'*(-len(d) % 2880))
+  f.close()
+
+
+def percentile(values, p):
+  """Return the p'th percentile (0-100) of a sorted list of values, using the
+     nearest rank.
+  """
+  i = int(round(p/100.0*(len(values)-1)))
+  return values[i]
+
+
+def sample(func, args=(), n=200, nops=1):
+  """Time func(*args) n times, and return a dictionary with the number of
+     operations per second, and the mean, min and percentiles of the time per
+     operation in microseconds. Each call counts as 'nops' operations. Very
+     fast functions are called enough times per sample to make each sample at
+     least a millisecond long, to keep the timer overhead out of the results.
+  """
+  t0 = time.time()
+  func(*args)
+  batch = max(1, int(1e-3/max(time.time()-t0, 1e-7)))
+  times = []
+  for i in xrange(n):
+    t0 = time.time()
+    for j in xrange(batch):
+      func(*args)
+    times.append((time.time()-t0)/batch/nops)
+  total = sum(times)
+  times.sort()
+  return {'n':n*batch*nops, 'ops_per_sec':round(n/total, 1),
+          'mean_us':round(total/n*1e6, 3), 'min_us':round(times[0]*1e6, 3),
+          'p50_us':round(percentile(times, 50)*1e6, 3),
+          'p90_us':round(percentile(times, 90)*1e6, 3),
+          'p99_us':round(percentile(times, 99)*1e6, 3)}
+
+
+def _parsecards(cards):
+  """Parse a list of FITS cards with fits._parseline, as the header reader does."""
+  ob = _Header()
+  ob.headers = {}
+  ob.comments = {}
+  for c in cards:
+    fits._parseline(ob, c)
+
+
+def bench_suite(n=200, names=None):
+  """Generate a synthetic FITS file for each of the named sites (default all
+     of them), time each stage of reading and analysing it, and return the
+     results as a list of dictionaries, one per site and operation.
+  """
+  random.seed(1)
+  tmpdir = tempfile.mkdtemp(prefix='fitsbench')
+  results = []
+  stdout = sys.stdout
+  try:
+    for site,cl in sites:
+      if names and site not in names:
+        continue
+      fname = os.path.join(tmpdir, site + '.fits')
+      synthfile(fname, site)
+      raw = open(fname, 'rb').read(2880*64)
+      cards = []
+      for i in xrange(0, len(raw), 80):
+        cards.append(raw[i:i+80])
+        if raw[i:i+8] == 'END     ':
+          break
+
+      f = fits.FITS(fname, 'r')
+      yg = fitstime.yearfromheaders(f.headers)
+      engine = fitstime.TimeEngine()
+      ops = [('parseline', _parsecards, (cards,), len(cards)),
+             ('open_h', fits.FITS, (fname, 'h'), 1),
+             ('open_r', fits.FITS, (fname, 'r'), 1),
+             ('parseheader', parseing.parseheader, (f.headers, f.comments, yg), 1),
+             ('findtime', engine.findtime, (fname,), 1),
+             ('hjd', coords.hjd, (2452814.76, 269.25, -28.5), 1),
+             ('save', f.save, (os.path.join(tmpdir, 'out.fits'),), 1)]
+      sys.stdout = open(os.devnull, 'w')     #Hide any warnings from the code being timed
+      try:
+        for op,func,args,nops in ops:
+          r = sample(func, args, n, nops)
+          r['site'] = site
+          r['op'] = op
+          r['cards'] = len(cards)
+          results.append(r)
+      finally:
+        sys.stdout = stdout
+  finally:
+    shutil.rmtree(tmpdir)
+  return results
+
+
+def report(results, asjson=0):
+  """Print the results from bench_suite as a table, or as a JSON document
+     (with details of the machine and software versions) if asjson is true.
+  """
+  if asjson:
+    import json
+    doc = {'benchmark':'fitstime', 'version':version, 'time':time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'python':platform.python_version(), 'platform':platform.platform(),
+           'numeric':fits.GotNum and (fits.Gotnumpy and 'numpy' or
+                                      fits.Gotnumarray and 'numarray' or 'Numeric') or None,
+           'results':results}
+    print json.dumps(doc, indent=1, sort_keys=True)
+    return
+  print "%-15s %-12s %12s %10s %10s %10s %10s" % ('Site', 'Operation', 'ops/sec', 'mean(us)',
+                                                   'p50(us)', 'p90(us)', 'p99(us)')
+  for r in results:
+    print "%-15s %-12s %12.1f %10.2f %10.2f %10.2f %10.2f" % (r['site'], r['op'], r['ops_per_sec'],
+                                                              r['mean_us'], r['p50_us'],
+                                                              r['p90_us'], r['p99_us'])
+
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  if not args:
+    print usage
+    sys.exit()
+
+  n = None
+  docoords = 0
+  dotable = 0
+  doencode = 0
+  doparse = 0
+  dosuite = 0
+  asjson = 0
+  names = []
+  files = []
+  for ar in args:
+    if ar == '-h' or ar == '-help' or ar == '--help':
+      print usage
+      sys.exit()
+    elif ar == '-coords' or ar == '--coords':
+      docoords = 1
+    elif ar == '-header' or ar == '--header':
+      doencode = 1
+    elif ar == '-table' or ar == '--table':
+      dotable = 1
+    elif ar == '-parse' or ar == '--parse':
+      doparse = 1
+    elif ar == '-suite' or ar == '--suite':
+      dosuite = 1
+    elif ar == '-json' or ar == '--json':
+      asjson = 1
+    elif ar[:2] == '-s':
+      names.append(ar[2:])
+    elif ar[:2] == '-n':
+      n = int(ar[2:])
+    else:
+      files.append(ar)
+
+  if dosuite:
+    report(bench_suite(n or 200, names), asjson)
+  if docoords:
+    bench_coords(n or 100000)
+  if dotable:
+    bench_table(n or 100000)
+  if doencode:
+    bench_encode(n or 5000)
+  if files and doparse:
+    bench_parse(files, n or 2000)
+  elif files:
+    bench_headers(files, n or 200)
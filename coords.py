@@ -1,15 +1,57 @@
 
 """PLANET Event name and date handling routines (Julian day, PJD, etc)
+
+   precess and hjd use rotation matrices, cached for each pair of epochs
+   rounded to precessquantum days. precesslist precesses a list of
+   coordinates with one matrix.
+
+   bjd gives the barycentric julian day, from the position of the Earth in
+   the Chebyshev ephemeris file 'earth.eph' (1980 to 2050), built by mkephem.
+
+   The functions with a 'v' prefix (vjuldate, vcaldate, vprecess, vhjd and vbjd) are
+   vectorized versions of the scalar functions, that accept numpy arrays (or 
+   scalars) and return arrays. They give the same results as the scalar code,
+   and are only defined if numpy is available.
    
    Written by Andrew Williams, Perth Observatory
    <andrew@physics.uwa.edu.au>
 """
 
+import os
+import sys
 import math
 import time
+import array
+import struct
+
+try:
+  import numpy
+  Gotnumpy = True
+except ImportError:
+  Gotnumpy = False
 
 J2000=2451544.5
 
+AUDAYS = 499.004784/86400.0      #Light travel time for 1 AU, in days
+
+#The Chebyshev ephemeris of the Earth's barycentric position, see mkephem.py
+ephemfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'earth.eph')
+_ephem = None
+
+#Reference barycentric positions of the Earth, from the IAU SOFA library
+#tests, as (JD(TDB), x, y, z) in AU on the J2000 equatorial axes. The first
+#is the expected result in the iauEpv00 test (iauEpv00 is a fit to JPL DE405,
+#good to a few km). The other two are the Earth positions given as inputs in
+#the iauApcg and iauApcs tests. They only cover 2005 to 2013, not the whole
+#range of the ephemeris. The ephemeris file is checked against them when it
+#is read, see checkephem.
+ephemrefs = [
+  (2453412.02501161, -0.7714104440491111971, 0.5598412061824171323, 0.2425996277722452400),
+  (2456165.901182685, 0.901310875, -0.417402664, -0.180982288),
+  (2456385.470031644, -0.974170438, -0.211520082, -0.0917583024),
+  ]
+ephemtolerance = 2e-4            #Largest difference allowed, in AU (0.1 s)
+
 
 def dsin(x):
   return math.sin(float(x)/180.0*math.pi)
@@ -140,54 +182,122 @@ def range(v=0, r=360.0):
   return v - r*math.floor(v/r);
 
 
+#Precession matrices are cached for each pair of epochs, rounded to the nearest
+#precessquantum days (0 for exact epochs). Precession moves a star by less than
+#0.2 arcsec a day, so frames from one night (or one campaign, for a coarser
+#quantum) share the same matrix. At most precesscache matrices are kept, and
+#the least recently used are dropped first.
+precessquantum = 1.0
+precesscache = 1000
+_pmatrices = {}            #(jd1,jd2) -> [matrix, last use]
+_pepochs = {}              #jd -> [matrix from 2000.0, last use]
+_puse = [0]
+
+
+def _quantise(jd):
+  "Return jd rounded to the nearest precessquantum days"
+  if precessquantum:
+    return math.floor(float(jd)/precessquantum + 0.5)*precessquantum
+  else:
+    return float(jd)
+
+
+def _fromJ2000(jd):
+  """Return the rotation matrix (a tuple of rows) that precesses unit vectors
+     from 2000.0 to epoch jd.
+  """
+  T = JDtoT(jd) - 1
+  zeta_A  = 0.6406161* T + 0.0000839* T*T + 0.0000050* T*T*T
+  z_A     = 0.6406161* T + 0.0003041* T*T + 0.0000051* T*T*T
+  theta_A = 0.5567530* T - 0.0001185* T*T - 0.0000116* T*T*T
+  zeta_A, z_A, theta_A = zeta_A/180.0*math.pi, z_A/180.0*math.pi, theta_A/180.0*math.pi
+  cz, sz = math.cos(zeta_A), math.sin(zeta_A)
+  cZ, sZ = math.cos(z_A), math.sin(z_A)
+  ct, st = math.cos(theta_A), math.sin(theta_A)
+  return ((cz*ct*cZ - sz*sZ, -sz*ct*cZ - cz*sZ, -st*cZ),
+          (cz*ct*sZ + sz*cZ, -sz*ct*sZ + cz*cZ, -st*sZ),
+          (cz*st,            -sz*st,            ct))
+
+
+def _mmul(a, b):
+  "Return the product of 3x3 matrices a and b"
+  return tuple([tuple([a[i][0]*b[0][j] + a[i][1]*b[1][j] + a[i][2]*b[2][j] for j in (0,1,2)])
+                for i in (0,1,2)])
+
+
+def _cached(cache=None, key=None, func=None):
+  "Return func(key), from the cache if it's there, otherwise adding it"
+  _puse[0] = _puse[0] + 1
+  try:
+    entry = cache[key]
+    entry[1] = _puse[0]
+    return entry[0]
+  except KeyError:
+    pass
+  value = func(key)
+  if len(cache) >= precesscache:      #Drop the least recently used half
+    items = cache.items()
+    items.sort(key=lambda x: x[1][1])
+    for k,e in items[:len(items) - precesscache/2]:
+      cache.pop(k, None)
+  cache[key] = [value, _puse[0]]
+  return value
+
+
+def _epochmatrix(jd):
+  """Return the matrix that precesses unit vectors from 2000.0 to epoch jd, or
+     None if jd is close enough to 2000.0 that no precession is done.
+  """
+  if (abs(jd - J2000)/365.25) <= .04:
+    return None
+  return _cached(_pepochs, jd, _fromJ2000)
+
+
+def _pairmatrix(key=None):
+  "Return the precession matrix from epoch key[0] to key[1]"
+  m1 = _epochmatrix(key[0])
+  m2 = _epochmatrix(key[1])
+  if m1 is None:
+    return m2 or ((1.0,0.0,0.0), (0.0,1.0,0.0), (0.0,0.0,1.0))
+  m1 = tuple(zip(*m1))           #Transpose, from jd1 to 2000.0
+  if m2 is None:
+    return m1
+  return _mmul(m2, m1)
+
+
+def precessmatrix(jd1=None, jd2=None):
+  """Return the rotation matrix (a tuple of rows) that precesses unit vectors
+     from epoch jd1 to jd2, with both epochs rounded to precessquantum days.
+     Matrices are cached, see precesscache.
+  """
+  return _cached(_pmatrices, (_quantise(jd1), _quantise(jd2)), _pairmatrix)
+
+
+def _rotate(m=None, ra=None, dec=None):
+  "Return the unit vector (x,y,z) for ra and dec (in degrees), rotated by matrix m"
+  cdec = dcos(dec)
+  x, y, z = cdec*dcos(ra), cdec*dsin(ra), dsin(dec)
+  return (m[0][0]*x + m[0][1]*y + m[0][2]*z,
+          m[1][0]*x + m[1][1]*y + m[1][2]*z,
+          m[2][0]*x + m[2][1]*y + m[2][2]*z)
+
+
+def _radec(x, y, z):
+  "Return (ra, dec) in degrees for unit vector (x,y,z)"
+  return range(datan2(y,x), 360.0), dasin(max(-1.0, min(1.0, z)))
+
+
 def precess(jd1=None, jd2=None, ra=None, dec=None):
   "Precess coords (in degrees) from epoch jd1 to jd2"
-  alpha_in = ra
-  delta_in = dec
-  
-  #precession progresses about 1 arc second in .047 years */
-  #From from_equinox to 2000.0 */
-                                                                                  
-  if (abs(jd1 - J2000)/365.25) > .04:
-    T = JDtoT(jd1) - 1
-    zeta_A  = 0.6406161* T + 0.0000839* T*T + 0.0000050* T*T*T
-    z_A     = 0.6406161* T + 0.0003041* T*T + 0.0000051* T*T*T
-    theta_A = 0.5567530* T - 0.0001185* T*T - 0.0000116* T*T*T
-                                                                                
-    A = dsin(alpha_in - z_A) * dcos(delta_in)
-    B = ( dcos(alpha_in - z_A) * dcos(theta_A) * dcos(delta_in)
-                               + dsin(theta_A) * dsin(delta_in) )
-    C = (-dcos(alpha_in - z_A) * dsin(theta_A) * dcos(delta_in)
-                              + dcos(theta_A) * dsin(delta_in) )
-                                                                                
-    alpha2000 = datan2(A,B) - zeta_A
-    alpha2000 = range(alpha2000, 360.0)
-    delta2000 = dasin(C)
-  else:
-    alpha2000 = alpha_in
-    delta2000 = delta_in
+  return _radec(*_rotate(precessmatrix(jd1, jd2), ra, dec))
 
-  #From 2000.0 to to_equinox */
-  if (abs(jd2 - J2000)/365.25) > .04:
-    T = JDtoT(jd2) - 1
-    zeta_A  = 0.6406161* T + 0.0000839* T*T + 0.0000050* T*T*T
-    z_A     = 0.6406161* T + 0.0003041* T*T + 0.0000051* T*T*T
-    theta_A = 0.5567530* T - 0.0001185* T*T - 0.0000116* T*T*T
-                                                                                
-    A = dsin(alpha2000 + zeta_A) * dcos(delta2000)
-    B = ( dcos(alpha2000 + zeta_A) * dcos(theta_A) * dcos(delta2000)
-         - dsin(theta_A) * dsin(delta2000) )
-    C = ( dcos(alpha2000 + zeta_A) * dsin(theta_A) * dcos(delta2000)
-         + dcos(theta_A) * dsin(delta2000) )
-                                                                                   
-    alpha = datan2(A,B) + z_A
-    alpha = range(alpha, 360.0)
-    delta = dasin(C)
-  else:
-    alpha = alpha2000
-    delta = delta2000
-                                                                                
-  return alpha, delta
+
+def precesslist(jd1=None, jd2=None, radecs=None):
+  """Precess a list of (ra,dec) tuples (in degrees) from epoch jd1 to jd2, and
+     return a list of (ra,dec) tuples. The same matrix is used for them all.
+  """
+  m = precessmatrix(jd1, jd2)
+  return [_radec(*_rotate(m, ra, dec)) for ra,dec in radecs]
 
 
 def hjd(jd=None, ra=None, dec=None):
@@ -199,20 +309,13 @@ def hjd(jd=None, ra=None, dec=None):
       double l;            /* mean solar ecliptic longitude */
       double R;            /* sun distance, AU */
       double X, Y;         /* equatorial rectangular solar coords */
-      double cdec, sdec;
-      double cra, sra;
+      double cdcra, cdsra, sdec;   /* precessed unit vector of the object */
       double deltajd;      /* HJD = JD - deltajd */
   """
                                                                                 
   #precess from J2000 (input equinox) to the observation equinox,
-  #where times are given in MJD
-  ra, dec = precess(J2000, jd, ra, dec)
-                                                                                
-  # do it to it
-  cdec = dcos(dec)
-  sdec = dsin(dec)
-  cra = dcos(ra)
-  sra = dsin(ra)
+  #as a unit vector (cdec*cra, cdec*sra, sdec)
+  cdcra, cdsra, sdec = _rotate(precessmatrix(J2000, jd), ra, dec)
                                                                                 
   n = jd - 2451545.0                    #use epoch 2000
   e = 23.439 - 0.0000004*n
@@ -223,8 +326,269 @@ def hjd(jd=None, ra=None, dec=None):
   X = R*dcos(l)
   Y = R*dcos(e)*dsin(l)
    
-  deltajd = 0.0057755 * (cdec*cra*X + (cdec*sra + dtan(e)*sdec)*Y)
+  deltajd = 0.0057755 * (cdcra*X + (cdsra + dtan(e)*sdec)*Y)
   return (jd-deltajd)
 
 
 
+class _Ephemeris:
+  """The Chebyshev coefficients read from an ephemeris file (see mkephem.py).
+     coefs[((seg*3)+axis)*ncoef + k] is coefficient k for axis (x,y,z) in
+     segment seg.
+  """
+  def __init__(self, fname=''):
+    f = open(fname, 'rb')
+    head = f.read(32)
+    magic, self.jd0, self.seglen, self.nseg, self.ncoef = struct.unpack('>8sddii', head)
+    if magic <> 'CHEBEPH1':
+      raise ValueError("Not an ephemeris file: "+fname)
+    self.coefs = array.array('d')
+    self.coefs.fromstring(f.read(8*self.nseg*3*self.ncoef))
+    f.close()
+    if sys.byteorder == 'little':
+      self.coefs.byteswap()
+    self.jd1 = self.jd0 + self.nseg*self.seglen
+    if Gotnumpy:
+      self.acoefs = numpy.array(self.coefs).reshape((self.nseg, 3, self.ncoef))
+
+
+def ephemeris():
+  """Return the ephemeris, reading it from ephemfile the first time. The
+     file is checked against ephemrefs, and ValueError is raised if it
+     differs by more than ephemtolerance.
+  """
+  global _ephem
+  if _ephem is None:
+    eph = _Ephemeris(ephemfile)
+    worst = _checkephem(eph)
+    if worst > ephemtolerance:
+      raise ValueError("Ephemeris %s differs from the reference positions by %.2g AU" % (ephemfile, worst))
+    _ephem = eph
+  return _ephem
+
+
+def _position(eph, jd):
+  "Return the Earth's position (x,y,z) in AU at the given JD from eph"
+  jd = float(jd)
+  if not (eph.jd0 <= jd < eph.jd1):
+    raise ValueError("JD %.5f is outside the range of the ephemeris" % jd)
+  seg = int((jd - eph.jd0)/eph.seglen)
+  u = 2.0*(jd - eph.jd0 - seg*eph.seglen)/eph.seglen - 1.0
+  n = eph.ncoef
+  out = []
+  for axis in (0,1,2):
+    c = eph.coefs[(seg*3 + axis)*n:(seg*3 + axis + 1)*n]
+    b1 = b2 = 0.0
+    for k in xrange(n-1, 0, -1):       #Clenshaw recurrence
+      b1, b2 = 2.0*u*b1 - b2 + c[k], b1
+    out.append(u*b1 - b2 + c[0])
+  return tuple(out)
+
+
+def _checkephem(eph):
+  "Return the largest difference, in AU, between eph and ephemrefs"
+  worst = 0.0
+  for jd,x,y,z in ephemrefs:
+    if eph.jd0 <= jd < eph.jd1:
+      ex,ey,ez = _position(eph, jd)
+      worst = max(worst, math.sqrt((ex-x)**2 + (ey-y)**2 + (ez-z)**2))
+  return worst
+
+
+def earthpos(jd=None):
+  """Return the position of the Earth relative to the solar system barycentre,
+     (x,y,z) in AU on the J2000 equatorial axes, at the given JD.
+  """
+  return _position(ephemeris(), jd)
+
+
+def bjd(jd=None, ra=None, dec=None):
+  """Calculate the barycentric julian day - input angles in degrees, J2000.
+     This is the time the light would have reached the solar system
+     barycentre, using the Earth's position from the ephemeris. Only the
+     light travel time (Roemer delay) is corrected, and the time scale of jd
+     is kept, so for a UTC julian day the result is BJD(UTC). The ephemeris
+     covers 1980 to 2050, and agrees with the positions in ephemrefs to
+     about 1e-4 AU (0.05 s).
+  """
+  x, y, z = earthpos(jd)
+  cdec = dcos(dec)
+  return jd + AUDAYS*(x*cdec*dcos(ra) + y*cdec*dsin(ra) + z*dsin(dec))
+
+
+def checkephem():
+  """Read ephemfile again and return the largest difference, in AU, between
+     its positions and the reference positions in ephemrefs. Raises
+     ValueError if this is more than ephemtolerance.
+  """
+  global _ephem
+  _ephem = None
+  ephemeris()
+  return _checkephem(_ephem)
+
+
+
+#Vectorized versions of the above, for large numbers of epochs or coordinates.
+#These follow the scalar code step by step, so the results agree with it.
+
+if Gotnumpy:
+
+  def vjuldate(year=None, month=None, day=None, hour=0, minute=0, second=0):
+    """Return an array of full Julian Days, given arrays (or scalars) of the date and
+       time components. Vectorized version of juldate.
+    """
+    year = numpy.asarray(year, numpy.float64)
+    month = numpy.asarray(month, numpy.float64)
+    early = (month == 1) | (month == 2)
+    year = numpy.where(early, year - 1, year)
+    month = numpy.where(early, month + 12, month)
+
+    A = numpy.floor(year/100.0)
+    B = 2 - A + numpy.floor(A/4.0)
+    jd = numpy.floor(365.25 * year) + numpy.floor(30.6001 * (month + 1))
+    jd = jd + (day + (hour + (numpy.asarray(minute)/60.0) + (numpy.asarray(second)/3600.0)) / 24.0)
+    jd = jd + (1720994 + B + 0.5)
+    return jd
+
+
+  def vcaldate(JD=None):
+    """Return a tuple of arrays (year,month,day) for an array of full Julian Days.
+       Vectorized version of caldate.
+    """
+    JD = numpy.asarray(JD, numpy.float64)
+    Z = numpy.trunc(JD + 0.5)
+    F = (JD + 0.5) - Z
+    alpha = numpy.trunc( (Z - 1867216.25)/36524.25 )
+    A = numpy.where(Z < 2299161, Z, Z + 1 + alpha - numpy.floor(alpha/4))
+    B = A + 1524
+    C = numpy.trunc( (B - 122.1)/365.25 )
+    D = numpy.trunc( 365.25*C )
+    E = numpy.trunc( (B - D)/30.6001 )
+    day = B - D - numpy.trunc(30.6001*E) + F
+    month = numpy.where(E < 13.5, E - 1, E - 13)
+    year = numpy.where(month > 2.5, C - 4716, C - 4715)
+    return (year.astype(int), month.astype(int), day)
+
+
+  def _vsin(x):
+    return numpy.sin(x/180.0*math.pi)
+
+  def _vcos(x):
+    return numpy.cos(x/180.0*math.pi)
+
+
+  def _vquantise(jd):
+    "Return an array of jd rounded to the nearest precessquantum days"
+    if precessquantum:
+      return numpy.floor(jd/precessquantum + 0.5)*precessquantum
+    else:
+      return jd
+
+
+  def _vfromJ2000(jd):
+    """Return an array of rotation matrices, shape (len(jd),3,3), that precess
+       unit vectors from 2000.0 to each epoch in jd. Vectorized version of
+       _fromJ2000, with the identity matrix where no precession is done.
+    """
+    T = (jd-2415020.0)/36525 - 1
+    zeta_A  = 0.6406161* T + 0.0000839* T*T + 0.0000050* T*T*T
+    z_A     = 0.6406161* T + 0.0003041* T*T + 0.0000051* T*T*T
+    theta_A = 0.5567530* T - 0.0001185* T*T - 0.0000116* T*T*T
+    cz, sz = _vcos(zeta_A), _vsin(zeta_A)
+    cZ, sZ = _vcos(z_A), _vsin(z_A)
+    ct, st = _vcos(theta_A), _vsin(theta_A)
+    m = numpy.array([[cz*ct*cZ - sz*sZ, -sz*ct*cZ - cz*sZ, -st*cZ],
+                     [cz*ct*sZ + sz*cZ, -sz*ct*sZ + cz*cZ, -st*sZ],
+                     [cz*st,            -sz*st,            ct]]).transpose((2,0,1))
+    near = (abs(jd - J2000)/365.25) <= .04
+    m[near] = numpy.identity(3)
+    return m
+
+
+  def _vrotate(jd1, jd2, ra, dec):
+    """Return arrays (x,y,z) of the unit vectors for ra and dec (in degrees),
+       precessed from epoch jd1 to jd2. If there is only one pair of epochs
+       (after rounding to precessquantum days), the cached matrix is used.
+    """
+    jd1, jd2, ra, dec = numpy.broadcast_arrays(numpy.asarray(jd1, numpy.float64),
+                                               numpy.asarray(jd2, numpy.float64),
+                                               numpy.asarray(ra, numpy.float64),
+                                               numpy.asarray(dec, numpy.float64))
+    cdec = _vcos(dec)
+    v = numpy.array([cdec*_vcos(ra), cdec*_vsin(ra), _vsin(dec)])
+    if jd1.size == 0:
+      return v[0], v[1], v[2]
+    if jd1.strides == jd2.strides == (0,)*jd1.ndim:      #Scalar epochs, broadcast
+      keys = numpy.array([[_quantise(jd1.flat[0]), _quantise(jd2.flat[0])]])
+    else:
+      keys = numpy.array([_vquantise(jd1).ravel(), _vquantise(jd2).ravel()]).T
+      keys, inverse = numpy.unique(keys, axis=0, return_inverse=True)
+    if len(keys) == 1:             #One matrix for all the coordinates
+      m = numpy.array(precessmatrix(keys[0][0], keys[0][1]))
+      v = numpy.tensordot(m, v, 1)
+    else:
+      m = numpy.einsum('kij,klj->kil', _vfromJ2000(keys[:,1]), _vfromJ2000(keys[:,0]))
+      v = numpy.einsum('...ij,j...->i...', m[inverse.reshape(jd1.shape)], v)
+    return v[0], v[1], v[2]
+
+
+  def vprecess(jd1=None, jd2=None, ra=None, dec=None):
+    """Precess coords (in degrees) from epoch jd1 to jd2. Any of the arguments can
+       be arrays. Vectorized version of precess.
+    """
+    x, y, z = _vrotate(jd1, jd2, ra, dec)
+    alpha = numpy.arctan2(y,x)*180/math.pi
+    alpha = alpha - 360.0*numpy.floor(alpha/360.0)
+    return alpha, numpy.arcsin(numpy.clip(z, -1.0, 1.0))*180/math.pi
+
+
+  def vhjd(jd=None, ra=None, dec=None):
+    """Calculate heliocentric julian days for arrays of JD, RA and DEC (in degrees).
+       Vectorized version of hjd.
+    """
+    jd = numpy.asarray(jd, numpy.float64)
+    cdcra, cdsra, sdec = _vrotate(J2000, jd, ra, dec)
+
+    n = jd - 2451545.0                    #use epoch 2000
+    e = 23.439 - 0.0000004*n
+    g = 357.528 + 0.9856003*n
+    L = 280.461 + 0.9856474*n
+    l = L + 1.915*_vsin(g) + 0.02*_vsin(2.0*g)
+    R = 1.00014 - 0.01671*_vcos(g) - 0.00014*_vcos(2.0*g)
+    X = R*_vcos(l)
+    Y = R*_vcos(e)*_vsin(l)
+
+    deltajd = 0.0057755 * (cdcra*X + (cdsra + _vsin(e)/_vcos(e)*sdec)*Y)
+    return (jd-deltajd)
+
+
+  def vearthpos(jd=None):
+    """Return arrays (x,y,z) of the Earth's barycentric position in AU, on the
+       J2000 equatorial axes, for an array of JD. Vectorized version of earthpos.
+    """
+    eph = ephemeris()
+    jd = numpy.asarray(jd, numpy.float64)
+    if jd.size and ((jd.min() < eph.jd0) or (jd.max() >= eph.jd1)):
+      raise ValueError("JD outside the range of the ephemeris")
+    seg = ((jd - eph.jd0)/eph.seglen).astype(int)
+    u = 2.0*(jd - eph.jd0 - seg*eph.seglen)/eph.seglen - 1.0
+    c = eph.acoefs[seg]                   #Coefficients for each epoch, shape (...,3,n)
+    b1 = numpy.zeros(jd.shape + (3,))
+    b2 = numpy.zeros(jd.shape + (3,))
+    u2 = 2.0*u[...,numpy.newaxis]
+    for k in xrange(eph.ncoef-1, 0, -1):    #Clenshaw recurrence
+      b1, b2 = u2*b1 - b2 + c[...,k], b1
+    pos = u[...,numpy.newaxis]*b1 - b2 + c[...,0]
+    return pos[...,0], pos[...,1], pos[...,2]
+
+
+  def vbjd(jd=None, ra=None, dec=None):
+    """Calculate barycentric julian days for arrays of JD, RA and DEC (in degrees,
+       J2000). Vectorized version of bjd.
+    """
+    jd = numpy.asarray(jd, numpy.float64)
+    x, y, z = vearthpos(jd)
+    cdec = _vcos(numpy.asarray(dec, numpy.float64))
+    return jd + AUDAYS*(x*cdec*_vcos(numpy.asarray(ra, numpy.float64)) +
+                        y*cdec*_vsin(numpy.asarray(ra, numpy.float64)) +
+                        z*_vsin(numpy.asarray(dec, numpy.float64)))
@@ -20,6 +20,18 @@
 # module will load without errors, but using '-r' will give a warning and only
 # load the header block.
 #
+# Mode 'm' (numpy only) reads the headers, and maps the data section from the
+# file with numpy.memmap instead of reading it. The .data attribute is then a
+# read-only MappedData object, and BSCALE/BZERO are only applied to the pixels
+# actually used, as the object is indexed or sliced, eg f.data[100:200,:].
+#
+# Files compressed with gzip or bzip2 (eg .fits.gz) are read transparently,
+# and only as much of the file as is read is decompressed, so reading just the
+# headers is fast. Saving to a file name ending in .gz or .bz2 compresses it.
+#
+# A member of a tar or zip archive can be read without extracting it, by
+# giving the file name as 'archive::member', eg 'night.tar::ZOB032.fits'.
+#
 # Use as:
 #
 # import fits
@@ -50,6 +62,12 @@ version = "$Revision$"
 import string        #load string handling library
 import types
 import time
+import gzip
+import bz2
+import os
+import tarfile
+import zipfile
+import threading
 
 GotNum = False
 Gotnumpy = False
@@ -92,29 +110,76 @@ for libname in trylibs:
     break    
 
 
+#Number of 2880-byte FITS blocks to read at a time when parsing the headers.
+#One block is enough for most files, larger values mean fewer reads for very
+#long headers (eg ESO files with hundreds of HIERARCH cards).
+readblocks = 1
+
+#Approximate number of bytes of image data (as Float64) to scale, convert and
+#write at a time in FITS.save, with numpy. The working buffers are this size,
+#instead of several temporary copies of the whole image.
+writechunk = 1024*1024
+
+#The same, for decoding (byte swapping, converting and scaling) the data section
+#in mode 'r', with numpy.
+readchunk = 1024*1024
+
+#Number of pixel values sampled for the median (sky) estimate in Stats.
+statsamples = 10000
+
+
 #Define two lists of cards that will be saved in the specified order, one at
 #the start of the FITS headers, one at the end. The rest will be in
-#alphabetical order between the two groups.
+#alphabetical order between the two groups. The axis lengths (NAXIS1 up to
+#NAXISn) always follow NAXIS, and then the other cards in hmandatory, to keep
+#the order required by the FITS standard for any number of axes, and for
+#table extensions.
 
-hfirst=['SIMPLE','BITPIX','NAXIS','NAXIS1','NAXIS2','EXTEND','COMMENT',
+hfirst=['SIMPLE','XTENSION','BITPIX','NAXIS','NAXIS1','NAXIS2','PCOUNT','GCOUNT','EXTEND','COMMENT',
         'CREATOR','OBSERVAT','TELESCOP','LATITUDE','LONGITUD','INSTRUME',
         'DETECTOR','INSTID','OBSERVER','OBJECT','EXPTIME']
 hlast=['CCDTEMP','GAIN','FILENAME','BSCALE','BZERO','HIERARCH','HISTORY','END']
+hmandatory=['GROUPS','PCOUNT','GCOUNT','TFIELDS']
+
+_endcard = 'END'.ljust(80)
+
+
+#Numpy type codes for the data types in BINTABLE TFORMn values. Logicals are
+#the characters 'T' or 'F', bits (X) are packed into bytes, and variable length
+#arrays (P and Q) are the (count, heap offset) pairs, not the arrays themselves.
+bintypes = {'L':'S1', 'X':'u1', 'B':'u1', 'I':'>i2', 'J':'>i4', 'K':'>i8',
+            'A':'S', 'E':'>f4', 'D':'>f8', 'C':'>c8', 'M':'>c16',
+            'P':'>i4', 'Q':'>i8'}
 
 
 class TABLE:
   """FITS table class, used only as an element of a FITS object. Like a FITS
      object, it has headers{}, comments{} and data attributes, but they refer
      to the extension, not the primary header.
+
+     An ASCII TABLE extension is parsed into a list of rows (tmode 'list'), a
+     dictionary of rows keyed by the first field (tmode 'dict'), or a
+     dictionary of columns keyed by field name (tmode 'columns'). In 'columns'
+     mode the whole table is read at once, and with numpy each column is
+     converted in one go into an array of strings, integers or floats, instead
+     of one value at a time. Without numpy each column is a list. A BINTABLE
+     extension (numpy only) isn't parsed at all, whatever the tmode - .data is
+     a numpy record array with a big-endian structured dtype built from the
+     TFORMn cards, viewing the table bytes read from the file, or mapped from
+     it with numpy.memmap if 'mapped' is true. Columns are accessed by name
+     without converting any rows, eg t.data['FLUX'], or with t.column('FLUX')
+     to apply any TSCALn and TZEROn values.
   """
-  def __init__(self, fileob=None, tmode='list'):
+  def __init__(self, fileob=None, tmode='list', mapped=0):
     self.file = fileob
     self.headers={}
     self.comments={}
-    self.finished=0
-    while not self.finished:
-      self.line=self.file.read(80)            #Read 80-byte cards
-      self.finished=_parseline(self,self.line)
+    _readheader(self, self.file)            #Read and parse the header blocks
+
+    if Gotnumpy and self.headers.get('XTENSION','')[1:-1].strip() == 'BINTABLE':
+      self.data = None
+      self._readbintable(mapped)
+      return
 
     try:
       if ( (self.headers['XTENSION'][1:-1].strip()<>'TABLE') or 
@@ -165,44 +230,344 @@ class TABLE:
         for f in self.fields[1:]:
           rowd.append( f[2](row[f[1]-1:f[1]-1+f[3]]) )
         self.data[k] = rowd
-    
+
+    elif tmode == 'columns':
+      buf = self.file.read(naxis1*naxis2)
+      if len(buf) <> naxis1*naxis2:
+        self.data = None
+        print "Expected %d bytes, read %d bytes." % (naxis1*naxis2, len(buf))
+        return
+      self.data = {}
+      if Gotnumpy:
+        block = frombuffer(buf, dtype=uint8, count=naxis1*naxis2).reshape((naxis2,naxis1))
+        for tn,tcol,tfunc,width in self.fields:
+          self.data[tn] = _column(block[:,tcol-1:tcol-1+width], tfunc)
+      else:
+        for tn,tcol,tfunc,width in self.fields:
+          col = []
+          for p in xrange(tcol-1, naxis1*naxis2, naxis1):
+            col.append(tfunc(buf[p:p+width]))
+          self.data[tn] = col
+
+  def _readbintable(self, mapped=0):
+    """Build the structured dtype for a BINTABLE extension, and view or map the
+       rows from the file, which is positioned at the start of the data section.
+    """
+    try:
+      tfields = int(self.headers['TFIELDS'])
+      naxis1 = int(self.headers['NAXIS1'])    #bytes per row
+      naxis2 = int(self.headers['NAXIS2'])    #number of rows
+    except:
+      return   #Not the headers we were expecting for a binary table
+
+    self.fields=[]
+    names, formats, offsets = [], [], []
+    pos = 0
+    for t in range(1,tfields+1):
+      tform = self.headers['TFORM%d' % t][1:-1].strip()
+      i = 0
+      while i < len(tform) and tform[i].isdigit():
+        i = i + 1
+      if i:
+        repeat = int(tform[:i])
+      else:
+        repeat = 1
+      code = tform[i:i+1]
+      if code == 'X':
+        width = (repeat+7)/8       #Bits are packed into bytes
+      elif code == 'P' or code == 'Q':
+        width = 2                  #Array descriptor
+      else:
+        width = repeat
+      if not bintypes.has_key(code):
+        print "Unrecognised TFORM%d value: %s" % (t, tform)
+        return
+      if code == 'A':
+        fmt = dtype('S%d' % repeat)
+      elif code == 'X':
+        fmt = dtype((bintypes[code], (width,)))
+      elif width == 1:
+        fmt = dtype(bintypes[code])
+      else:
+        fmt = dtype((bintypes[code], (width,)))
+
+      if self.headers.has_key('TTYPE%d' % t):
+        tn = self.headers['TTYPE%d' % t][1:-1].strip()
+      else:
+        tn = 'col%d' % t
+      if (not tn) or (tn in names):
+        tn = 'col%d' % t           #Field names must be unique, and not blank
+      if fmt.itemsize:             #Zero width columns take no space in the row
+        names.append(tn)
+        formats.append(fmt)
+        offsets.append(pos)
+      self.fields.append( (tn,pos+1,fmt,fmt.itemsize) )
+      pos = pos + fmt.itemsize
+
+    rowtype = dtype({'names':names, 'formats':formats, 'offsets':offsets,
+                     'itemsize':naxis1})
+    doff = self.file.tell()
+    if mapped and naxis2:
+      raw = memmap(self.file.name, dtype=rowtype, mode='r', offset=doff, shape=(naxis2,))
+    else:
+      buf = self.file.read(naxis1*naxis2)
+      if len(buf) <> naxis1*naxis2:
+        print "Expected %d bytes, read %d bytes." % (naxis1*naxis2, len(buf))
+        return
+      raw = frombuffer(buf, dtype=rowtype)     #A read-only view of the string, no copy
+    self.data = raw.view(recarray)
+
+  def column(self, name=''):
+    """Return the named column of a binary table. This is a view of the table
+       data unless the column has TSCALn or TZEROn cards, in which case it's a
+       new Float64 array with the scaling applied.
+    """
+    col = self.data[name]
+    for t in range(len(self.fields)):
+      if self.fields[t][0] == name:
+        break
+    n = t + 1
+    if self.headers.has_key('TSCAL%d' % n) or self.headers.has_key('TZERO%d' % n):
+      col = col * float(self.headers.get('TSCAL%d' % n, '1')) + float(self.headers.get('TZERO%d' % n, '0'))
+    return col
+
+
+def _column(chars, tfunc):
+  """Convert one field of an ASCII table, given as a numpy array of the field's
+     characters in each row, into an array of strings, integers or floats. The
+     numbers are parsed by numpy, from the fields joined with spaces between
+     them, which is much faster than converting each one with int or float.
+     That's only done if every field holds exactly one word, so that a blank
+     field and one with a space in it can't shift values into the wrong rows -
+     otherwise each field is converted separately, and a bad one raises
+     ValueError, as it does in tmode 'list'.
+  """
+  nrows,width = chars.shape
+  if tfunc is str:
+    return chars.copy().view('S%d' % width).reshape((nrows,))
+  if tfunc is int:
+    ctype = int
+  else:
+    ctype = Float64
+  inword = chars > ord(' ')
+  words = inword[:,0] + (inword[:,1:] & ~inword[:,:-1]).sum(axis=1)    #Words in each field
+  if nrows and (words == 1).all():
+    spaced = empty((nrows,width+1), uint8)
+    spaced[:,:width] = chars
+    spaced[:,width] = ord(' ')
+    values = fromstring(spaced.tostring(), dtype=ctype, sep=' ')
+    if len(values) == nrows:
+      return values
+  return chars.copy().view('S%d' % width).reshape((nrows,)).astype(ctype)
+
+
+class Stats:
+  """Statistics of the pixel values in an image, accumulated a chunk at a time
+     as the data section is decoded (see FITS, with stats=1), instead of with
+     extra passes over the whole array afterwards. They describe the data as
+     it was decoded, and aren't updated if the array is changed later. The
+     attributes are:
+
+     count     - the number of pixels
+     min, max  - the lowest and highest values, the same as data.min() and
+                 data.max() (so NaN if there are any NaN pixels)
+     mean      - the mean value, with any NaN pixels left out
+     sky       - the median of an evenly spaced sample of about statsamples
+                 pixels (leaving out NaNs), an estimate of the sky level
+     satlevel  - the saturation level, see FITS._satlevel, or None
+     saturated - the number of pixels at or above satlevel, or None
+  """
+  def __init__(self, npix=0, satlevel=None):
+    self.count = 0
+    self.satlevel = satlevel
+    if satlevel is None:
+      self.saturated = None
+    else:
+      self.saturated = 0
+    self.step = max(1, npix/statsamples)   #Pixels between samples
+    self._mins, self._maxs, self._samples = [], [], []
+    self._sum = 0.0
+    self._nans = 0
+
+  def add(self, chunk):
+    """Add the pixel values in 'chunk', the next part of the image, in order."""
+    flat = chunk.ravel()
+    if not len(flat):
+      return
+    self._mins.append(flat.min())
+    self._maxs.append(flat.max())
+    s = flat.sum()
+    if s <> s:                #NaN, leave out the NaN pixels
+      nans = isnan(flat)
+      self._nans = self._nans + int(nans.sum())
+      s = flat[~nans].sum()
+    self._sum = self._sum + s
+    self._samples.append(flat[(-self.count) % self.step::self.step].copy())
+    if self.satlevel is not None:
+      err = seterr(invalid='ignore')      #NaN pixels aren't saturated
+      try:
+        self.saturated = self.saturated + int(count_nonzero(flat >= self.satlevel))
+      finally:
+        seterr(**err)
+    self.count = self.count + len(flat)
+
+  def finish(self):
+    """Work out the final values, once all the chunks have been added."""
+    if self.count:
+      self.min = array(self._mins).min()
+      self.max = array(self._maxs).max()
+    else:
+      self.min = self.max = None
+    if self.count > self._nans:
+      self.mean = self._sum/(self.count-self._nans)
+    else:
+      self.mean = None
+    sample = concatenate(self._samples + [zeros(0)])
+    sample = sample[~isnan(sample)]
+    if len(sample):
+      self.sky = float(median(sample))
+    else:
+      self.sky = None
+    self._mins, self._maxs, self._samples = [], [], []
+
+
+def _decode(fraw='', type=None, shape=(), bscale=None, bzero=None, stats=None):
+  """Convert the raw big-endian data section 'fraw' of the given type into a
+     Float64 array of the given shape, applying bscale and bzero if given,
+     a chunk of rows at a time so there are no whole-image temporary arrays.
+     The values are the same as converting and scaling the whole array at
+     once. If a Stats object is given, each chunk is added to it as it's
+     decoded.
+  """
+  data = empty(shape, Float64)
+  rawtype = dtype(type).newbyteorder('>')
+  nrows = shape[0]
+  rowsize = max(1, data.size/max(1,nrows))         #Elements per row
+  step = max(1, readchunk/(8*rowsize))             #Rows per chunk
+  for r in xrange(0, nrows, step):
+    chunk = data[r:r+step]
+    chunk[...] = frombuffer(fraw, rawtype, chunk.size,
+                            r*rowsize*rawtype.itemsize).reshape(chunk.shape)
+    if bscale is not None:
+      multiply(chunk, bscale, chunk)
+      add(chunk, bzero, chunk)
+    if stats is not None:
+      stats.add(chunk)
+  if stats is not None:
+    stats.finish()
+  return data
+
+
+class MappedData:
+  """Read-only view of a FITS data section, mapped from the file by numpy.memmap,
+     used as the .data attribute of a FITS object read with mode 'm'. Indexing
+     or slicing it returns a normal Float64 array (or a float), with BSCALE
+     and BZERO applied, so only the part of the file actually used is read
+     and scaled. Use data[...] to get the whole array. The raw, unscaled,
+     big-endian values are available as the .raw attribute.
+  """
+  def __init__(self, raw, bscale=None, bzero=None):
+    self.raw = raw
+    self.bscale = bscale
+    self.bzero = bzero
+    self.shape = raw.shape
+    self.ndim = raw.ndim
+    self.size = raw.size
+    self.dtype = dtype(Float64)
+
+  def __len__(self):
+    return len(self.raw)
+
+  def __getitem__(self, key):
+    v = array(self.raw[key], Float64)
+    if self.bscale is not None:    #Scale the same way as mode 'r'
+      multiply(v, self.bscale, v)
+      add(v, self.bzero, v)
+    if v.ndim == 0:
+      return v[()]
+    return v
+
+  def __array__(self, dtype=None):
+    if dtype is None:
+      return self[...]
+    return self[...].astype(dtype)
+
 
 class FITS:
   """FITS image class. Creation accepts two parameters, filename and read mode.
      If the read mode is 'h', the file headers are read, and two dictionaries,
      object.headers and object.comments are created. If the read mode is 'r', 
      the data section is read as well, producing a Numeric Python array 
-     attribute, object.data. If the filename is null, an empty (but valid FITS)
+     attribute, object.data. If the read mode is 'm', the data section is
+     mapped from the file instead of being read, and object.data is a 
+     MappedData object that scales pixels as they are accessed (this needs
+     numpy, otherwise mode 'r' is used). If the filename is null, an empty (but valid FITS)
      header is constructed, and a 512x512 pixel data section, initialised to 
      zeroes (unless the mode is 'h' for headers only).
 
      It also includes the 'save' method, for writing the image to a file, or
      just the header block if there is no data section.
 
-     Adding experimental code for simple FITS table reading (but not writing)
+     If a timer object is given (eg a fitstime.StageTimer), the time taken to
+     open the file, parse the header cards, and read the data section are
+     passed to timer.add() as the stages 'open', 'cards' and 'data'.
+
+     If stats is true, and the data is read with numpy in mode 'r', the
+     statistics of the pixel values are accumulated as the data is decoded,
+     in a Stats object, object.stats (see Stats), without another pass over
+     the data. The statistics describe the data as it was read - they aren't
+     updated if object.data is changed afterwards. If the data is saved
+     unchanged, save(..., usestats=1) uses their min and max instead of
+     another two passes over the array.
+
+     For a multi-extension file, 'ext' selects the HDU to read instead of the
+     primary one, either by number (0 for the primary HDU, 1 for the first
+     extension, etc) or by EXTNAME. The headers of the other HDUs are read
+     to find it, but not their data sections. An IMAGE extension is read
+     like a primary image, and any other type of extension with mode 'r' is
+     read as a TABLE, in the .table attribute. If there is no such HDU,
+     NoSuchHDU is raised. See also hduindex().
+
+     If ext isn't given, and the primary HDU has no data section (NAXIS = 0),
+     data is None. With mode 'r', if the first extension is a TABLE or
+     BINTABLE, it's read into .table, otherwise nothing else is read - use
+     'ext' to read an IMAGE (or any other) extension.
+
+     Adding experimental code for simple FITS table reading (but not writing),
+     of ASCII tables, and binary tables with numpy - see TABLE.
   """
 
-  def __init__(self, filename='', mode='r', tmode='list'): 
+  def __init__(self, filename='', mode='r', tmode='list', timer=None, ext=None, stats=0): 
                                   #mode is 'h' (headers) or 'r' (data+headers)
+                                  #or 'm' (headers+memory mapped data)
     self.filename=filename
+    if mode=='m' and not (Gotnumpy and filename and _mappable(filename)):
+      mode = 'r'           #Can only map data from an uncompressed file with numpy
+    self.hdrsize = 0      #Bytes in the header blocks of the file read, if any
+    self.hdroffset = 0    #Position of those header blocks in the file
+    self.primaryheaders = None     #Primary header cards, if an extension was read
+    self.stats = None     #Pixel statistics, if asked for
+    self._statsdata = None     #The array they were worked out from
     if mode=='h':          #Mode h opens file, reads headers, closes the file
       self.data = None
       if not filename:
         self.headers={'SIMPLE':'T', 'EXTEND':'T', 'NAXIS':'2'}
         self.comments={'COMMENT':'Empty header','HISTORY':''}
       else:
-        self.file=open(self.filename,'r')
-        self.headers={}
-        self.comments={}
-        self.finished=0
-        while not self.finished:
-          self.line=self.file.read(80)            #Read 80-byte cards
-          self.finished=_parseline(self,self.line)
+        if timer:
+          t0 = time.time()
+        self.file=openfile(self.filename)
+        if timer:
+          t1 = time.time()
+          timer.add('open', t1-t0)
+        self._readcards(ext)                    #Read and parse the header blocks
         self.file.close()
+        if timer:
+          timer.add('cards', time.time()-t1)
         if not self.comments.has_key('HISTORY'):
           self.comments['HISTORY']=''            #Add a blank HISTORY card
 
-    if mode=='r':          #Mode h opens file, reads headers and data
+    if mode=='r' or mode=='m':     #Mode r opens file, reads headers and data
       if not filename:
         self.headers={'SIMPLE':'T', 'EXTEND':'T', 'NAXIS':'2', 
                       'NAXIS1':'512', 'NAXIS2':'512', 'BITPIX':'-32'}
@@ -213,19 +578,31 @@ class FITS:
           self.data = None
           print "Numeric library not present, can't create data section."
       else:
-        self.file=open(self.filename,'r')
-        self.headers={}
-        self.comments={}
-        self.finished=0
-        while not self.finished:
-          self.line=self.file.read(80)            #Read 80-byte cards
-          self.finished=_parseline(self,self.line)
+        if timer:
+          t0 = time.time()
+        self.file=openfile(self.filename)
+        if timer:
+          t1 = time.time()
+          timer.add('open', t1-t0)
+        self._readcards(ext)                    #Read and parse the header blocks
         if not self.comments.has_key('HISTORY'):
           self.comments['HISTORY']=''            #Add a blank HISTORY card
+        if timer:
+          t2 = time.time()
+          timer.add('cards', t2-t1)
 
-        if self.headers['NAXIS'] == '0':  #If there's no primary data array
-          self.file.seek(2880*((self.file.tell()-1)/2880+1))
-          self.table = TABLE(self.file, tmode=tmode)  #Assume it's a FITS table
+        if self.headers.has_key('XTENSION') and _unquote(self.headers['XTENSION']) <> 'IMAGE':
+          self.data = None
+          self.file.seek(self.hdroffset)
+          self.table = TABLE(self.file, tmode=tmode, mapped=(mode=='m'))    #Not an image extension
+        elif self.hdroffset and self.headers['NAXIS'] == '0':
+          self.data = None                  #Empty image extension
+        elif self.headers['NAXIS'] == '0':  #If there's no primary data array
+          self.data = None
+          hdus = _walkhdus(self.file, 1)
+          if len(hdus) > 1 and hdus[1].xtension in ['TABLE', 'BINTABLE']:
+            self.file.seek(hdus[1].hdroffset)
+            self.table = TABLE(self.file, tmode=tmode, mapped=(mode=='m'))  #Read the first extension's table
         elif GotNum:         #If we've got Numeric, load the data section too.
           self.file.seek(2880*((self.file.tell()-1)/2880+1))
           bp=int(self.headers['BITPIX'])
@@ -250,18 +627,47 @@ class FITS:
           else:
             flen=flen*4   #Four bytes per element
           shape.reverse()  #take axes in opposite order
+
+          if mode=='m':    #Map the data section instead of reading it
+            doff = self.file.tell()
+            self.file.seek(0,2)
+            if self.file.tell()-doff < flen:
+              self.data = None
+              print "Expected %d bytes, found %d bytes." % (flen, self.file.tell()-doff)
+              return
+            self.file.close()
+            raw = memmap(self.filename, dtype=dtype(type).newbyteorder('>'),
+                         mode='r', offset=doff, shape=tuple(shape))
+            if self.headers.has_key('BSCALE') and self.headers.has_key('BZERO'):
+              self.data = MappedData(raw, float(self.headers['BSCALE']),
+                                          float(self.headers['BZERO']))
+            else:
+              self.data = MappedData(raw)
+            if timer:
+              timer.add('data', time.time()-t2)
+            return
+
           fraw = self.file.read(flen)
           if len(fraw) <> flen:
             self.data = None
             print "Expected %d bytes, read %d bytes." % (flen, len(fraw))
             return
           if Gotnumpy:
-            self.data = fromstring(fraw,type).byteswap(True).astype(Float64)
+            if self.headers.has_key('BSCALE') and self.headers.has_key('BZERO'):
+              bscale=float(self.headers['BSCALE'])
+              bzero=float(self.headers['BZERO'])
+            else:
+              bscale = bzero = None
+            if stats:
+              self.stats = Stats(flen/dtype(type).itemsize, self._satlevel(bp))
+            self.data = _decode(fraw, type, tuple(shape), bscale, bzero, self.stats)
+            if stats:
+              self._statsdata = self.data
           else:
             self.data = fromstring(fraw,type).byteswapped().astype(Float64)
-          self.data.shape=tuple(shape)
+            self.data.shape=tuple(shape)
 
-          if self.headers.has_key('BSCALE') and self.headers.has_key('BZERO'):
+          if (not Gotnumpy) and self.headers.has_key('BSCALE') and self.headers.has_key('BZERO'):
             bscale=float(self.headers['BSCALE'])
             bzero=float(self.headers['BZERO'])
             multiply(self.data,bscale,self.data)
@@ -271,8 +677,65 @@ class FITS:
           self.data = self.file.read()
 
         self.file.close()
+        if timer:
+          timer.add('data', time.time()-t2)
+
+  def _readcards(self, ext=None):
+    """Read and parse the header cards of the primary HDU in self.file, or the
+       one given by 'ext', into self.headers and self.comments, leaving the
+       file positioned at the start of its data section. Sets self.hdroffset
+       and self.hdrsize if the END card was found.
+    """
+    self.headers={}
+    self.comments={}
+    if ext is None:
+      found = _readheader(self, self.file)
+    else:
+      hdus = _walkhdus(self.file, ext, self)
+      if not hdus or not hdus[-1].matches(ext):
+        self.file.close()
+        raise NoSuchHDU("No HDU %s in %s" % (`ext`, self.filename))
+      self.hdroffset = hdus[-1].hdroffset
+      found = 1
+    if found:
+      self.hdrsize = self.file.tell() - self.hdroffset   #Size of header, in bytes
+
+  def inherited(self):
+    """Return the header dictionary, with the cards from the primary header
+       added to it if this image was read from an extension with INHERIT = T.
+       Cards in the extension header take precedence, and the cards describing
+       the primary data section aren't added. The headers attribute itself
+       isn't changed, so save() and update() only write the extension's cards.
+    """
+    if not self.primaryheaders or self.headers.get('INHERIT') <> 'T':
+      return self.headers
+    h = {}
+    for k,v in self.primaryheaders.items():
+      if k not in ['SIMPLE','BITPIX','EXTEND','BSCALE','BZERO'] and not k.startswith('NAXIS'):
+        h[k] = v
+    h.update(self.headers)
+    return h
 
-  def save(self, fname='/tmp/out.fits', bitpix=None):
+  def _satlevel(self, bitpix=0):
+    """Return the saturation level for the pixel values, from the SATURATE card
+       if there is one, otherwise the largest value that can be stored with an
+       integer BITPIX (after BSCALE and BZERO), or None for floating point.
+    """
+    try:
+      return float(self.headers['SATURATE'])
+    except (KeyError, ValueError):
+      pass
+    if bitpix == 16:
+      top = 32767.0
+    elif bitpix == 32:
+      top = 2147483647.0
+    else:
+      return None
+    if self.headers.has_key('BSCALE') and self.headers.has_key('BZERO'):
+      return top*float(self.headers['BSCALE']) + float(self.headers['BZERO'])
+    return top
+
+  def save(self, fname='/tmp/out.fits', bitpix=None, usestats=0):
     """Saves image to a given file name. The bitpix field has the same meaning
        as the FITS header BITPIX, ie 16 or 32 for signed integers, and -32 for
        32-bit floating point. The BSCALE, BZERO, NAXIS1 and NAXIS2 cards are
@@ -280,20 +743,28 @@ class FITS:
        the bitpix value from the original header is used. If bitpix is zero,
        then only the header cards are written - a warning is given if a data
        section was read, but not written.
+
+       If usestats is true, and the image was read with stats=1, the min and
+       max in self.stats are used to choose BSCALE and BZERO, instead of
+       working them out from the data again. This is only done if self.data
+       is still the array that was read, but changes made to the values in
+       that array can't be detected, so only ask for it if the data hasn't
+       been changed.
     """
     self.filename = fname
+    self.hdrsize = 0     #The header written may not match the one read
+    self.hdroffset = 0
+    if self.headers.has_key('XTENSION'):     #Write an image extension as a primary image
+      for h in ['XTENSION', 'PCOUNT', 'GCOUNT']:
+        if self.headers.has_key(h):
+          del self.headers[h]
+      self.headers['SIMPLE'] = 'T'
+    if self.headers.has_key('INHERIT'):      #Only allowed in an extension
+      del self.headers['INHERIT']
 
     if not GotNum:
-      f = open(fname,'w')
-      for h in hfirst:            #Write the initial header cards
-        f.write(_fh(self, h))
-      tmplist = self.headers.keys()
-      tmplist.sort()
-      for h in tmplist:           #Write most of the header cards, sorted
-        if (h not in hfirst) and (h not in hlast):
-          f.write(_fh(self, h))
-      for h in hlast:             #Write the final header cards
-        f.write(_fh(self, h))
+      f = openfile(fname,'w')
+      f.write(_header(self))      #Write the header cards
 
       if self.data is not None:
         if bitpix == 0:             #Writing header only
@@ -310,6 +781,9 @@ class FITS:
           return 0
         return 1
 
+    if isinstance(self.data, MappedData):
+      self.data = self.data[...]    #Read in the whole of a mapped data section
+
     if bitpix <> int(self.headers['BITPIX']):
       rescale = True     #Rescale if new bitpix value differs from old
     else:
@@ -330,7 +804,10 @@ class FITS:
         fitsmax = 2147483647.0
         self.headers['BITPIX'] = '32'
     
-      if Gotnumpy:
+      if usestats and self.stats is not None and self.data is self._statsdata:
+        dmin = self.stats.min      #Found as the data was read
+        dmax = self.stats.max
+      elif Gotnumpy:
         dmin = self.data.min()
         dmax = self.data.max()
       else:
@@ -371,9 +848,10 @@ class FITS:
         bzero = ibzero
       
 
-      tmpdata = self.data + (0.5*bscale - bzero)     #Creates copy of data so original is safe
-      divide(tmpdata,bscale,tmpdata)
-      floor(tmpdata, tmpdata) 
+      if not Gotnumpy:       #With numpy, the data is scaled a chunk at a time as it's written
+        tmpdata = self.data + (0.5*bscale - bzero)     #Creates copy of data so original is safe
+        divide(tmpdata,bscale,tmpdata)
+        floor(tmpdata, tmpdata) 
       self.headers['BSCALE'] = `bscale`
       self.headers['BZERO'] = `bzero`
     elif bitpix == -32:               #For floating point, don't scale the data
@@ -381,6 +859,7 @@ class FITS:
       self.headers['BSCALE'] = '1'
       self.headers['BZERO'] = '0'
       tmpdata = self.data
+      bscale = bzero = None  #Don't scale the values written
     elif bitpix == 0:
       if len(self.data):        #Warn if we are only writing the header when data exists
         print "Warning: writing header only, no data, to "+fname
@@ -401,27 +880,45 @@ class FITS:
     else:
       type=None
 
-    f = open(fname,'w')
-
-    for h in hfirst:            #Write the initial header cards
-      f.write(_fh(self, h))
-    tmplist = self.headers.keys()
-    tmplist.sort()
-    for h in tmplist:           #Write most of the header cards, sorted
-      if (h not in hfirst) and (h not in hlast):
-        f.write(_fh(self, h))
-    for h in hlast:             #Write the final header cards
-      f.write(_fh(self, h))
+    f = openfile(fname,'w')
+
+    f.write(_header(self))      #Write the header cards
     if bitpix <> 0:             #Write the data section unless bitpix is 0
       f.write(' ' * (2880*((f.tell()-1)/2880+1)-f.tell()) )    #Pad the header block
       if Gotnumpy:
-        f.write(tmpdata.astype(type).byteswap(True).tostring())
+        _writedata(f, self.data, type, bscale, bzero)
       else:
         f.write(tmpdata.astype(type).byteswapped().tostring())
       f.write('\0' * (2880*((f.tell()-1)/2880+1)-f.tell()) )    #Pad the data
     f.close()
     return 1
 
+  def update(self):
+    """Rewrite the header cards of the file this image was read from, in
+       place, without reading or writing the data section. This is only 
+       possible if the new header fits in the header blocks already in the 
+       file (including the blank padding after the old END card), so adding
+       a few cards to an existing image is usually OK. The header cards
+       describing the data section (BITPIX, NAXIS, BSCALE, etc) should not
+       be changed, because the data isn't re-encoded to match.
+
+       Returns 1 if the header was updated, or 0 if the new header didn't fit,
+       in which case the file is unchanged and save() must be used instead.
+       For an image read from an extension, only that extension's header is
+       rewritten. A compressed file, or archive member, can't be updated in
+       place.
+    """
+    if not self.filename or not self.hdrsize or not _mappable(self.filename):
+      return 0
+    hstr = _header(self)
+    if len(hstr) > self.hdrsize:
+      return 0
+    f = open(self.filename,'r+b')
+    f.seek(self.hdroffset)
+    f.write(hstr + ' ' * (self.hdrsize-len(hstr)))    #Pad to the old header size
+    f.close()
+    return 1
+
   def saveraw(self, fname=''):
     """Save the data section of the image (without headers) as a raw array of 32-bit floats.
     """
@@ -557,51 +1054,563 @@ def _parseline(ob,line):
 
 
 
+def _readheader(ob, fileob, nblocks=None):
+  """Read the FITS header cards from fileob, starting at the current file
+     position, and parse them into ob.headers and ob.comments using
+     _parseline. The file is read a whole 2880-byte block at a time (or
+     'nblocks' blocks, default given by the module variable readblocks), 
+     instead of one 80-byte card at a time.
+
+     On return the file is positioned at the start of the block following
+     the END card, ie at the start of the data section, if there is one.
+     Returns 1 if an END card was found, or 0 if the file ended first.
+  """
+  if not nblocks:
+    nblocks = readblocks
+  start = fileob.tell()
+  offset = 0                   #Bytes read so far, relative to start
+  while 1:
+    buf = fileob.read(2880*nblocks)
+    if not buf:
+      return 0                 #End of file without an END card
+    for i in xrange(0, len(buf), 80):
+      if _parseline(ob, buf[i:i+80]):       #Found the END card
+        dstart = start + 2880*((offset+i)/2880+1)
+        if fileob.tell() <> dstart:         #Read past the end of the header
+          fileob.seek(dstart)
+        return 1
+    offset = offset + len(buf)
+    if len(buf) < 2880*nblocks:
+      return 0                 #Short read, file ended without an END card
+
+
+class _Cards:
+  """Holds the headers and comments dictionaries filled in by _readheader, when
+     there's no FITS object to put them in.
+  """
+  def __init__(self):
+    self.headers = {}
+    self.comments = {}
+
+
+def _unquote(value=''):
+  """Return a FITS string value without its quotes or trailing spaces."""
+  if value.startswith("'"):
+    return value[1:-1].rstrip()
+  return value
+
+
+def _datasize(headers={}):
+  """Return the size in bytes of the data section described by the header
+     dictionary, including the padding to a whole number of 2880-byte blocks.
+  """
+  naxis = int(headers.get('NAXIS','0'))
+  if naxis == 0:
+    n = 0
+  else:
+    n = 1
+    for i in range(1,naxis+1):
+      if i == 1 and headers.get('GROUPS') == 'T' and headers.get('NAXIS1') == '0':
+        continue           #Random groups, NAXIS1=0 isn't a real axis
+      n = n*int(headers['NAXIS%d' % i])
+  n = (abs(int(headers['BITPIX']))/8 * int(headers.get('GCOUNT','1')) *
+       (int(headers.get('PCOUNT','0')) + n))
+  return 2880*((n+2879)/2880)
+
+
+class NoSuchHDU(KeyError):
+  "The HDU given by 'ext' isn't in the file"
+  pass
+
+
+class HDU:
+  """The position and type of one header/data unit in a FITS file, as found
+     by hduindex(). The number is 0 for the primary HDU, 1 for the first
+     extension, etc. Offsets are in bytes from the start of the file, and
+     datasize includes the padding after the data. The xtension attribute is
+     None for the primary HDU, otherwise the XTENSION value (eg 'IMAGE' or
+     'BINTABLE'), and extname is the EXTNAME value, if any.
+  """
+  def __init__(self, number=0, hdroffset=0, dataoffset=0, headers={}):
+    self.number = number
+    self.hdroffset = hdroffset
+    self.dataoffset = dataoffset
+    self.datasize = _datasize(headers)
+    if headers.has_key('XTENSION'):
+      self.xtension = _unquote(headers['XTENSION'])
+    else:
+      self.xtension = None
+    if headers.has_key('EXTNAME'):
+      self.extname = _unquote(headers['EXTNAME'])
+    else:
+      self.extname = None
+    self.extver = int(headers.get('EXTVER','1'))
+
+  def __repr__(self):
+    return '<HDU %d %s %s at %d, %d data bytes at %d>' % (self.number, self.xtension,
+              self.extname, self.hdroffset, self.datasize, self.dataoffset)
+
+  def matches(self, ext=None):
+    """Return true if this HDU is the one given by 'ext', either its number,
+       or its EXTNAME (case insensitive).
+    """
+    if type(ext) == types.IntType:
+      return self.number == ext
+    return (self.extname is not None) and (self.extname.upper() == ext.upper())
+
+
+def _walkhdus(fileob, ext=None, ob=None):
+  """Read the header of each HDU in fileob in turn, from the start of the
+     file, seeking past the data sections without reading them. Returns the
+     list of HDU objects found. If 'ext' is given, stop at the HDU that
+     matches it, in which case its cards are left in ob.headers and
+     ob.comments (if ob is given) and the file is positioned at the start of
+     its data section. If that isn't the primary HDU, the primary header
+     cards are left in ob.primaryheaders.
+  """
+  hdus = []
+  offset = 0
+  while 1:
+    if fileob.tell() <> offset:
+      fileob.seek(offset)     #Seek forward over the data section
+    cards = _Cards()
+    if not _readheader(cards, fileob):
+      break               #End of file, or padding or junk after the last HDU
+    if (hdus and not cards.headers.has_key('XTENSION')) or (not hdus and not cards.headers.has_key('SIMPLE')):
+      break
+    hdu = HDU(len(hdus), offset, fileob.tell(), cards.headers)
+    if not hdus:
+      primary = cards.headers
+    hdus.append(hdu)
+    if ext is not None and hdu.matches(ext):
+      if ob is not None:
+        ob.headers = cards.headers
+        ob.comments = cards.comments
+        if hdu.number:
+          ob.primaryheaders = primary
+      break
+    offset = hdu.dataoffset + hdu.datasize
+  return hdus
+
+
+def hduindex(filename=''):
+  """Return a list of HDU objects, giving the header and data offsets, and
+     data size, of the primary HDU and each extension in the file. Only the
+     header blocks are read.
+  """
+  f = openfile(filename)
+  try:
+    return _walkhdus(f)
+  finally:
+    f.close()
+
+
+#File name endings recognised as tar or zip archives by isarchive
+archivetypes = ['.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tbz', '.zip']
+
+_archives = {}                #Member index for each archive opened, see _index
+_archivelock = threading.Lock()
+_spare = threading.local()    #The _TarStream last used by each thread, see _tarstream
+
+
+def splitmember(filename=''):
+  """Split a file name of the form 'archive::member' into (archive, member).
+     For any other file name, return (filename, None).
+  """
+  if '::' in filename:
+    archive, member = filename.split('::', 1)
+    return archive, member
+  return filename, None
+
+
+def isarchive(filename=''):
+  """Return true if the file name (not an archive member) ends with one of the
+     archive types in archivetypes.
+  """
+  if '::' in filename:
+    return False
+  lname = filename.lower()
+  for ext in archivetypes:
+    if lname.endswith(ext):
+      return True
+  return False
+
+
+class _Archive:
+  """The index of a tar or zip archive - the names of the regular files in it,
+     in archive order, and where each one is. For a tar file (compressed or
+     not), members[name] is (offset, size), the position of the member's data
+     in the uncompressed tar stream. For a zip file, it's the ZipInfo object.
+
+     A zip file's index is read from its central directory when it's opened.
+     A tar file's index is filled in as its member headers are reached, by
+     the same stream that reads the members (see _TarStream), so reading the
+     members in archive order is a single pass through the archive, even
+     when it's compressed. complete is true once the whole index is known.
+  """
+  def __init__(self, archive=''):
+    self.archive = archive
+    self.names = []
+    self.members = {}
+    self.zipfile = None
+    self.complete = False
+    if zipfile.is_zipfile(archive):
+      self.zipfile = zipfile.ZipFile(archive, 'r')
+      for zi in self.zipfile.infolist():
+        if not zi.filename.endswith('/'):
+          self.names.append(zi.filename)
+          self.members[zi.filename] = zi
+      self.complete = True
+
+  def scan(self, stream=None):
+    """Read the next member header from _TarStream 'stream', adding the member
+       to the index if it's a regular file that isn't already there. Returns
+       false if there are no more members.
+    """
+    ti = stream.tar.next()
+    if ti is None:
+      self.complete = True
+      return False
+    if ti.isreg():
+      _archivelock.acquire()
+      try:
+        if not self.members.has_key(ti.name):
+          self.names.append(ti.name)
+          self.members[ti.name] = (ti.offset_data, ti.size)
+      finally:
+        _archivelock.release()
+    stream.tar.members = []     #Don't keep every TarInfo
+    return True
+
+
+def _index(archive=''):
+  """Return the _Archive index for the given archive, starting a new one the
+     first time, or if the archive has changed since.
+  """
+  path = os.path.abspath(archive)
+  st = os.stat(archive)
+  _archivelock.acquire()
+  try:
+    if (not _archives.has_key(path)) or (_archives[path][0] <> (st.st_size, st.st_mtime)):
+      _archives[path] = ((st.st_size, st.st_mtime), _Archive(archive))
+    return _archives[path][1]
+  finally:
+    _archivelock.release()
+
+
+def archivemembers(archive=''):
+  """Yield the names of the regular files in a tar or zip archive, in the
+     order they are stored, as 'archive::member' file names. The names in a
+     tar file are found as the archive is read, so if each member is opened
+     as its name is yielded, the archive is only read (and decompressed) once.
+  """
+  index = _index(archive)
+  i = 0
+  while 1:
+    if i < len(index.names):
+      yield archive + '::' + index.names[i]
+      i = i + 1
+    elif index.complete:
+      return
+    else:
+      stream = _tarstream(archive)
+      try:
+        index.scan(stream)
+      finally:
+        stream.close()
+
+
+class _TarStream:
+  """An open stream through a tar file (decompressed, if it's a .tar.gz or
+     .tar.bz2), and a tarfile.TarFile reading the member headers from the same
+     stream as they are reached. The stream only moves forward, as the member
+     headers and data are read in turn. close() keeps it for the next member
+     read in this thread, see _tarstream.
+  """
+  def __init__(self, archive=''):
+    self.archive = archive
+    self.raw = openfile(archive)
+    self.tar = tarfile.TarFile(fileobj=self.raw)     #Reads the first member header
+
+  def canscan(self):
+    """Return true if the next member header can be read without going back."""
+    return self.tar.firstmember is not None or self.raw.tell() <= self.tar.offset
+
+  def close(self):
+    old = getattr(_spare, 'stream', None)
+    if old is not None and old is not self:
+      old.raw.close()
+    _spare.stream = self
+
+
+def _tarstream(archive='', offset=None):
+  """Return a _TarStream for the tar file 'archive'. The stream left by the
+     last member read in this thread is re-used if it's the same archive and
+     it can still reach 'offset' (or read the next member header, if offset is
+     None) without going back, otherwise a new stream is opened.
+  """
+  spare = getattr(_spare, 'stream', None)
+  if spare is not None:
+    _spare.stream = None
+    if spare.archive == archive:
+      if offset is None and spare.canscan():
+        return spare
+      elif offset is not None and spare.raw.tell() <= offset:
+        return spare
+    spare.raw.close()
+  return _TarStream(archive)
+
+
+class _Member:
+  """A read-only file object for one member of a tar or zip archive, as returned
+     by openfile() for an 'archive::member' file name. Positions are relative
+     to the start of the member. The archive is only read as the member is.
+  """
+  def __init__(self, archive='', member=''):
+    self.name = archive + '::' + member
+    self.archive = archive
+    self.index = _index(archive)
+    self.stream = None
+    if self.index.zipfile is None and not self.index.members.has_key(member):
+      stream = _tarstream(archive)      #Read on through the archive to find it
+      try:
+        while not self.index.members.has_key(member) and self.index.scan(stream):
+          pass
+      finally:
+        stream.close()
+    if not self.index.members.has_key(member):
+      raise IOError("No member %s in archive %s" % (member, archive))
+    self.info = self.index.members[member]
+    if self.index.zipfile is None:
+      self.base, self.size = self.info
+      self.stream = _tarstream(archive, self.base)
+      self.raw = self.stream.raw
+    else:
+      self.base, self.size = 0, self.info.file_size
+      self.raw = self.index.zipfile.open(self.info)
+    self.rawpos = None       #Position in the member that raw is at, if known
+    self.pos = 0
+    self.closed = False
+
+  def _sync(self):
+    """Move the raw stream to the current position in the member."""
+    if self.rawpos == self.pos:
+      return
+    if self.index.zipfile is None:
+      self.raw.seek(self.base + self.pos)
+    else:                    #Zip members can't seek, read forward or start again
+      if self.rawpos is None or self.pos < self.rawpos:
+        self.raw.close()
+        self.raw = self.index.zipfile.open(self.info)
+        self.rawpos = 0
+      while self.rawpos < self.pos:
+        skip = len(self.raw.read(min(self.pos-self.rawpos, 1024*1024)))
+        if not skip:
+          break
+        self.rawpos = self.rawpos + skip
+    self.rawpos = self.pos
+
+  def read(self, n=-1):
+    left = self.size - self.pos
+    if n < 0 or n > left:
+      n = left
+    if n <= 0:
+      return ''
+    self._sync()
+    buf = self.raw.read(n)
+    self.pos = self.pos + len(buf)
+    self.rawpos = self.pos
+    return buf
+
+  def tell(self):
+    return self.pos
+
+  def seek(self, offset=0, whence=0):
+    if whence == 1:
+      offset = offset + self.pos
+    elif whence == 2:
+      offset = offset + self.size
+    self.pos = max(0, offset)
+
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
+    if self.stream is not None:
+      self.stream.close()      #Keep it for the next member
+    else:
+      self.raw.close()
+
+
+def _mappable(filename=''):
+  """Return true if the file is a plain file on disk, that can be mapped with
+     numpy.memmap or updated in place.
+  """
+  return splitmember(filename)[1] is None and not compression(filename)
+
+
+def compression(filename=''):
+  """Return 'gzip' or 'bzip2' if the file 'filename' is compressed, as shown
+     by the first few bytes of the file, or None if it isn't.
+  """
+  f = open(filename, 'rb')
+  magic = f.read(3)
+  f.close()
+  if magic[:2] == '\x1f\x8b':
+    return 'gzip'
+  elif magic == 'BZh':
+    return 'bzip2'
+  return None
+
+
+def openfile(filename='', mode='r'):
+  """Open a FITS file for reading, or for writing if mode is 'w'. A file that's
+     compressed with gzip or bzip2 is decompressed as it's read, so only as
+     much of it as is actually read is decompressed (eg just the header blocks
+     in mode 'h'). A file written with a name ending in '.gz' or '.bz2' is
+     compressed the same way. A file name of the form 'archive::member' is a
+     member of a tar or zip archive (which can't be written).
+  """
+  if mode == 'w':
+    if filename.endswith('.gz'):
+      return gzip.GzipFile(filename, 'wb')
+    elif filename.endswith('.bz2'):
+      return bz2.BZ2File(filename, 'w')
+    return open(filename, 'wb')
+  archive, member = splitmember(filename)
+  if member is not None:
+    return _Member(archive, member)
+  c = compression(filename)
+  if c == 'gzip':
+    return gzip.GzipFile(filename, 'rb')
+  elif c == 'bzip2':
+    return bz2.BZ2File(filename, 'r')
+  return open(filename, 'rb')
+
+
+def headercomplete(filename=''):
+  """Return 1 if the file 'filename' contains a complete primary FITS header
+     (ie the END card has been written), or 0 if it doesn't, or can't be
+     read. Used to tell when a file that is still being written (eg by a
+     camera) has enough in it to analyse the header.
+  """
+  try:
+    f = openfile(filename)
+  except IOError:
+    return 0
+  try:
+    try:
+      if f.read(6) <> 'SIMPLE':
+        return 0
+      f.seek(0)
+      return _readheader(_Cards(), f)
+    except (IOError, EOFError):
+      return 0                 #Compressed file that's been cut short
+  finally:
+    f.close()
+
+
+def _writedata(f, data, type, bscale=None, bzero=None):
+  """Write the numpy array 'data' to the file f, converted to the given type and
+     byte swapped, a chunk of rows at a time. If bscale is given, the values
+     written are floor((data - bzero)/bscale + 0.5), calculated exactly as
+     save() has always done, so the bytes written are the same, but only a
+     chunk-sized working buffer is used instead of whole-image temporaries.
+  """
+  nrows = data.shape[0]
+  rowsize = max(1, data.size/max(1,nrows))        #Elements per row
+  step = max(1, writechunk/(8*rowsize))           #Rows per chunk
+  out = empty((min(step,nrows),)+data.shape[1:], type)
+  if bscale is not None:
+    offset = 0.5*bscale - bzero
+    buf = empty(out.shape, result_type(data, offset))   #Same type as data+offset
+  for r in xrange(0, nrows, step):
+    chunk = data[r:r+step]
+    o = out[:len(chunk)]
+    if bscale is not None:
+      b = buf[:len(chunk)]
+      add(chunk, offset, b)
+      divide(b, bscale, b)
+      floor(b, b)
+      o[...] = b
+    else:
+      o[...] = chunk
+    o.byteswap(True)
+    f.write(o.tostring())
+
+
+def _header(fim=None):
+  """Given an image, return all of the formatted header cards as one string,
+     in the order they are written to a file - the cards in hfirst, with the
+     NAXISn cards and those in hmandatory after NAXIS, then the rest in
+     alphabetical order, then the cards in hlast. The header is not padded
+     out to a full 2880-byte block.
+  """
+  out = []
+  first = _firstcards(fim.headers)
+  fixed = dict.fromkeys(first+hlast)
+  for h in first:             #The initial header cards
+    out.append(_fh(fim, h))
+  tmplist = fim.headers.keys()
+  tmplist.sort()
+  for h in tmplist:           #Most of the header cards, sorted
+    if not fixed.has_key(h):
+      out.append(_fh(fim, h))
+  for h in hlast:             #The final header cards
+    out.append(_fh(fim, h))
+  return ''.join(out)
+
+
+def _firstcards(headers={}):
+  """Return the list of cards written at the start of the header: hfirst, but
+     with NAXIS followed by NAXIS1 to NAXISn for the number of axes given in
+     'headers', and then the cards in hmandatory.
+  """
+  try:
+    naxis = int(headers.get('NAXIS','0'))
+  except ValueError:
+    naxis = 0
+  i = hfirst.index('NAXIS') + 1
+  axes = ['NAXIS%d' % n for n in range(1,naxis+1)]
+  rest = [h for h in hfirst[i:] if not h.startswith('NAXIS') and h not in hmandatory]
+  return hfirst[:i] + axes + hmandatory + rest
+
+
 def _fh(fim=None, h=''):
-  """Given an image and a header key, return the 80-byte formatted header card.
+  """Given an image and a header key, return the 80-byte formatted header card
+     (or cards, for COMMENT, HISTORY and HIERARCH, one per line).
 
      A null card is returned for an error, and can be ignored since it's safe
      to write an empty string to the FITS header.
   """
-  h=string.upper(h)
+  h = h.upper()
   if not fim:
     return '' 
-  try:
-    if h=='END':
-      return string.ljust('END',80)
-    elif h == 'COMMENT' or h == 'HISTORY':
-      lines=string.split(fim.comments[h],'\n')
-      out=''
-      for l in lines:
-        out = out + string.ljust(string.ljust(h,8)+l, 80)[:80]
-      return out
-    elif h == 'HIERARCH':
-      lines=string.split(fim.comments[h],'\n')
-      out=''
-      for l in lines:
-        out = out + string.ljust('HIERARCH '+l, 80)[:80]
-      return out
-    elif h not in fim.headers.keys():
+  if h == 'END':
+    return _endcard
+  elif h == 'COMMENT' or h == 'HISTORY' or h == 'HIERARCH':
+    if not fim.comments.has_key(h):
       return ''
+    if h == 'HIERARCH':
+      fmt = 'HIERARCH %-71.71s'
     else:
-      v=fim.headers[h]
-      v=" ".join(v.split('\n'))
-      if v=="":
-        return string.ljust(h,80)[:80]
-      out = string.ljust(h,8)[:8] + '= '
-      if v[0]=='"' or v[0]=="'":
-        out=out+string.ljust(v,20)
-      else:
-        out=out+string.rjust(v,20)
-      if fim.comments.has_key(h):
-        cm = " ".join(fim.comments[h].split('\n'))
-        out=out+' / '+cm
-      out=string.ljust(out,80)
-      if len(out)>80:
-        out=out[:80]
-    return out
-  except KeyError:
+      fmt = h.ljust(8) + '%-72.72s'     #One 80-column card per line
+    lines = fim.comments[h].split('\n')
+    return (fmt*len(lines)) % tuple(lines)
+  elif not fim.headers.has_key(h):
     return ''
+  v = fim.headers[h]
+  if '\n' in v:
+    v = v.replace('\n', ' ')
+  if v == "":
+    return h[:80].ljust(80)
+  if v[0] == '"' or v[0] == "'":
+    out = h[:8].ljust(8) + '= ' + v.ljust(20)
+  else:
+    out = h[:8].ljust(8) + '= ' + v.rjust(20)
+  if fim.comments.has_key(h):
+    out = out + ' / ' + fim.comments[h].replace('\n', ' ')
+  return out[:80].ljust(80)
 
 
 
@@ -10,12 +10,25 @@
 
 version = "$Revision$"
 
+import os
 import sys
+import copy
+import time
+import fnmatch
+import heapq
+import marshal
+import tempfile
+import itertools
+import traceback
+from cStringIO import StringIO
 
 import parseing
 import fits
 import coords
 
+if coords.Gotnumpy:
+  import numpy
+
 basefield = 'HJD_Calc'       #The base julian day field to use for output times
                              #The default, HJD_Calc, is derived from the best date
                              #and time fields, plus half the exptime, plus the 
@@ -25,11 +38,18 @@ hcorr=0   #Don't add or subtract the heliocentric correction to the base field
 ecorr=0   #Don't add or subtract half the exptime to the base field result
 mcorr=0   #Any extra modifier, generally +/- 0.5 for broken JD/MJD conversions
 
+pollinterval = 0.2           #Seconds between directory scans in watch mode
+sortrunsize = 100000         #Results held in memory at once when sorting output
+batchsize = 256              #Files analysed at once with --show, if numpy is available
+fitspatterns = ['*.fits', '*.fit', '*.fts']     #FITS file names, in watched directories and archives
+
 
 
 usage="""FITS header time analysis - Andrew Williams
 usage:  fitstime [-h|-help|--help]  OR
-        fitstime [options] [filename] [filename] ...
+        fitstime [options] [filename] [filename] ...  OR
+        fitstime [options] [--sort] --from=FILE [filename] ...  OR
+        fitstime [options] --watch=DIR [--done=FILE] [pattern] [pattern] ...
 
 where options can be:
 -s, -S, --show   Give a full analysis of all time fields in the header,
@@ -65,10 +85,71 @@ where options can be:
 		 warning or guessing. The (broken) 'month/day/year' order isn't
 		 supported.
 
+--cache=FILE     Keep the analysis of each file in the cache database FILE,
+                 and use that instead of reading the file again on later
+                 runs, unless the file's header has changed.
+
+-j N, -jN        Analyse the files using N worker processes, for large 
+                 numbers of files on a multi-core machine. The output is
+                 the same, in the same order, as when the files are done
+                 one at a time. An error in one file is reported in the
+                 output for that file, instead of stopping the run.
+
+--sort           Print the results in order of output time, instead of in
+                 the order the files were given. Files with no time come
+                 last, in their original order. Temporary files are used
+                 to sort very large numbers of results, so the memory
+                 needed stays small.
+
+--from=FILE      Read the names of the files to analyse from FILE, one per
+                 line, after any given on the command line. If FILE is '-',
+                 the names are read from standard input, eg:
+                 find /data -name '*.fits' | fitstime --sort --from=-
+
+--watch=DIR      Instead of analysing the files given, watch the directory
+                 DIR for new files (eg from a camera), and analyse each one
+                 as soon as its FITS header has been completely written.
+                 Any arguments other than options are file name patterns to
+                 watch for, the default is '*.fits *.fit *.fts'. Runs until
+                 interrupted with Ctrl-C.
+
+--done=FILE      In watch mode, the names of files that have been analysed
+                 are added to FILE, and those files are skipped when the
+                 watch is restarted. The default is '.fitstime-done' in the
+                 watched directory.
+
+--learn=FILE     Learn which header fields give the time for each instrument
+                 (identified by the TELESCOP, OBSERVAT and INSTRUME cards),
+                 keeping what is learned in the database FILE, and only
+                 parse those fields for later images from that instrument.
+                 If an image doesn't fit what was learned, it's analysed in
+                 full, and its fields are learned instead. Warnings about
+                 fields that aren't used are not given, and --learn has no
+                 effect with --show.
+
+--ext=N, --ext=NAME
+                 Read the header of extension N (1 for the first extension)
+                 or the extension with EXTNAME NAME, instead of the primary
+                 header, in multi-extension FITS files. If the extension has
+                 INHERIT = T, the primary header cards are used as well.
+                 Only the headers before it are read to find it.
+
+--profile        Time each stage of the processing (opening the file,
+                 parsing the header cards, parseheader, choosing the best
+                 values, matching JD fields, and the whole of findtime), and
+                 print a table of the count, total, mean and 95th percentile
+                 times for each stage to standard error at the end.
+
 Typically you would do 'fitstime --show *.fits' to examine the time fields
 present in your images, and check them for consistency. Normally, you could
-then 'fitstime *.fits > times.txt' to produce a sorted HJD-midpoint time
-list. 
+then 'fitstime --sort *.fits > times.txt' to produce a sorted HJD-midpoint
+time list. 
+
+A file name can also be a tar or zip archive (.tar, .tar.gz, .tgz, .tar.bz2
+or .zip), to analyse the FITS files in it (*.fits, *.fit and *.fts) in the
+order they are stored, without extracting them, or one member of an archive,
+given as 'archive::member', eg 'fitstime --show night.tar::ZOB032.fits'.
+Files compressed with gzip or bzip2 (eg *.fits.gz) are read directly.
 
 If you see from the analysis output that a different field (eg JD) produces 
 midpoint-HJD times, or you wish to apply an offset, then specify this on the 
@@ -222,119 +303,31 @@ def yearfromheaders(hdic=None):
     
   
 
-class HeaderFields:
-  pass          #An instance of this is used to store the header fields sorted by group.
+#Offsets tried when matching JD fields against each other, in the order they are tried,
+#as (sign of heliocentric correction, sign of exptime/2, extra offset in days). The last
+#combination that matches a pair of fields within 2e-4 days (about 17 sec) is reported.
 
-
-def findtime(fname='', fimage=None, verbose=1, allfields=0):
-  try:
-    if not fimage:
-      f = fits.FITS(fname,'h')
-    else:
-      f = fimage
-
-    yearguess = yearfromheaders(f.headers)    #Parse other header fields for year to break 2-digit-year degeneracy
-    hf = HeaderFields()
-    (hf.dates,hf.times,hf.jds,hf.hjds,
-     hf.ras,hf.decs,hf.equinoxes,hf.exptimes, outstring) = parseing.parseheader(f.headers, f.comments, yearguess)
-
-    #parseheader returns lists of all values in each category (all dates, all ras, etc). Each list
-    #is composed of tuples, being (value, field, confidence), where value is the number, field is 
-    #a string containing the name of the FITS header field it was derived from, and confidence
-    #is a number from 0 to ~200 containing the 'confidence' that that field is valid'. 
-
-  except AssertionError:
-    print "#Error opening or parseing FITS headers in file: "+fname
-    sys.excepthook(*sys.exc_info())
-    print
-    if allfields:
-      return None,"#Error opening or parseing FITS headers in file: "+fname+"\n", None
-    else:
-      return None,"#Error opening or parseing FITS headers in file: "+fname+"\n"
-
-  if verbose and fname:
-    outstring += "\nFinding time in: "+fname+"\n"
-
-  ftime,ftimefield,os2 = gettime(hf.times, hf.dates, verbose=verbose)
-  fdate,fdatefield,os1 = getdate(hf.dates, verbose=verbose)
-  fjd,fjdfield,os3 = getjd(hf.jds+hf.hjds, verbose=verbose)    
-  fra,frafield,os4 = getra(hf.ras, verbose=verbose)
-  fdec,fdecfield,os5 = getdec(hf.decs, verbose=verbose)
-  fequinox,fequinoxfield,os6 = getequinox(hf.equinoxes, verbose=verbose)
-  fexptime,fexptimefield,os7 = getexptime(hf.exptimes, verbose=verbose)
-  outstring += "".join([os1,os2,os3,os4,os5,os6,os7])
-
-  #Above calls extract the 'best' value in each category, by sorting based on confidence. If there is
-  #more than one value for a category, compare the best and second best to check consistency. If there's
-  #no value in a category, make up a reasonable default if appropriate (eg equinox of J2000).
-
-  if fexptime:
-    edelta = (fexptime/2.0)/86400       #Half the exposure time, in days
-  else:
-    if verbose:
-      outstring += "No exposure time information, can't verify or calculate time offsets\n"
-    edelta = 0.0
-
-
-  #Calculate HJD_Calc from the best date and time field, and find the heliocentric offset
-
-  if fdate and ftime:
-    cjd = coords.juldate(data=(fdate[0], fdate[1], int(fdate[2]),
-                                 ftime[0], ftime[1], ftime[2], 0,0,0))
-    chjd = coords.hjd(jd=cjd, ra=fra*15.0, dec=fdec)
-    hdelta = chjd - cjd
-    chjd = chjd + edelta
-    hf.hjds.insert(0,(chjd,"HJD_Calc",200))
-    chjdfield = "(" + fdatefield + " & " + ftimefield + " + Hel.Corr. + Exptime/2)"
-  elif fjd:
-    ghjd = coords.hjd(jd=fjd, ra=fra*15.0, dec=fdec)
-    hdelta = ghjd - fjd
-  else:
-    if verbose:
-      outstring += "No date and time, or any form of JD field. No idea how to find the time for this image...\n"
-    chjdfield = "(no data)"
-    if allfields:
-      return None, outstring, hf
-    else:
-      return None, outstring
+matchoffsets = []
+for _hs,_hstr in [(-1," -Hel.Corr."), (0,""), (+1," +Hel.Corr.")]:
+  for _es,_estr in [(-1," -Exptime/2"), (0,""), (+1," +Exptime/2")]:
+    for _m,_mstr in [(-0.5," -0.5"), (0.0,""), (+0.5," +0.5")]:
+      matchoffsets.append((_hs, _es, _m, _hstr+_estr+_mstr))
 
 
-  if ( (abs(hdelta)<1e-4) or (edelta<1e-4)) and verbose:
-    outstring += "Heliocentric or exptime/2 offset is less than 0.0001 days, can't reliably compare JD offsets\n"
-
-  if verbose:
-    outstring += "Calculated HJD_Calc from "+chjdfield+"\n"
-    outstring += "Hel.Corr = %8.6f (%6.2f sec)  Exptime/2 = %8.6f (%6.2f sec) \n" % (hdelta,
-                                                                                     hdelta*86400,
-                                                                                     edelta,
-                                                                                     edelta*86400)
-
+def matchjds(jdict=None, hdelta=0.0, edelta=0.0):
+  """Compare every field containing a JD or HJD value in jdict with every other
+     (later in alphabetical order), for all combinations of heliocentric, 
+     half-exptime and half-day offsets in matchoffsets. Returns (matches, clashes), 
+     where matches[akey][bkey] is a tuple of the string describing the offsets, and 
+     the error in days, for the last match found between fields akey and bkey, and 
+     clashes[akey] is a list of the fields that differ from akey by over a day.
+  """
   hdl = [(-hdelta," -Hel.Corr."), (0.0,""), (+hdelta," +Hel.Corr.")]
   edl = [(-edelta," -Exptime/2"), (0.0,""), (+edelta," +Exptime/2")]
   mdl = [(-0.5," -0.5"), (0.0,""), (+0.5," +0.5")]
 
-  jdict = {}
-  for item in hf.jds + hf.hjds:
-    jdict[item[1]] = item[0]
-
-  if not verbose:
-    try:
-      out = jdict[basefield]
-    except KeyError:         #The base field isn't available
-      return None, outstring + "Invalid base field specified\n"
-    out = out + hcorr*hdelta + ecorr*edelta + mcorr
-    if allfields:
-      return out, outstring, hf
-    else:
-      return out, outstring
-
   jlist = jdict.keys()
   jlist.sort()
-
-  #Now compare every field containing a JD or HJD value with every other, checking for close matches,
-  #for all possible combinations of heliocentric, half-exptime and half-day offsets. For each match, 
-  #store the match key names, a string specifying which offsets were used, and and error, in days.
-
   matches = {}
   clashes = {}
   for akey in jlist:
@@ -352,27 +345,720 @@ def findtime(fname='', fimage=None, verbose=1, allfields=0):
             offsetstring = hd[1] + ed[1] + md[1]
             if abs(ajd - (bjd+offset)) < 2e-4:       #About 17 seconds
               matches[akey][bkey] = ( offsetstring, ajd - (bjd+offset) )
+  return matches, clashes
 
-  for akey in jlist:
-    outstring += akey + " = " + `jdict[akey]` + '\n'
-    for bkey in matches[akey].keys():
-      outstring += " "*len(akey) + " = " + bkey + (matches[akey][bkey][0] + 
-                   "   (" + str(round(matches[akey][bkey][1]*86400,2)) +" sec error)\n" )
 
-  for akey in jlist:
-    for bkey in clashes[akey]:
-      outstring += "Warning: %s=%9.5f and %s=%9.5s differ by more than one day!" % (akey, jdict[akey], bkey, jdict[bkey])
-      print "Warning: %s=%9.5f and %s=%9.5s differ by more than one day!" % (akey, jdict[akey], bkey, jdict[bkey])
+def vmatchjds(jdicts=None, hdeltas=None, edeltas=None):
+  """Batch version of matchjds, for a list of jdict dictionaries, and lists of the
+     heliocentric correction and half-exptime for each. Every pair of fields in
+     every header is tested against all the offsets at once with numpy arrays.
+     Returns a list of (matches, clashes) tuples, the same as matchjds would
+     return for each header. Without numpy, matchjds is called for each one.
+  """
+  if not coords.Gotnumpy:
+    return [matchjds(jdicts[i], hdeltas[i], edeltas[i]) for i in range(len(jdicts))]
+
+  out = []
+  pa, pb, pf, pkeys = [], [], [], []   #Values, header index and key names for each pair
+  for i in range(len(jdicts)):
+    jdict = jdicts[i]
+    jlist = jdict.keys()
+    jlist.sort()
+    matches = {}
+    clashes = {}
+    for j in range(len(jlist)):
+      akey = jlist[j]
+      matches[akey] = {}
+      clashes[akey] = []
+      for bkey in jlist[j+1:]:
+        pa.append(jdict[akey])
+        pb.append(jdict[bkey])
+        pf.append(i)
+        pkeys.append((akey,bkey))
+    out.append((matches, clashes))
+  if not pa:
+    return out
+
+  a = numpy.array(pa)[:,numpy.newaxis]
+  b = numpy.array(pb)[:,numpy.newaxis]
+  pf = numpy.array(pf)
+  hd = numpy.array(hdeltas, dtype=numpy.float64)[pf][:,numpy.newaxis]
+  ed = numpy.array(edeltas, dtype=numpy.float64)[pf][:,numpy.newaxis]
+  hs = numpy.array([o[0] for o in matchoffsets], dtype=numpy.float64)
+  es = numpy.array([o[1] for o in matchoffsets], dtype=numpy.float64)
+  ms = numpy.array([o[2] for o in matchoffsets])
+  offset = (hs*hd + es*ed) + ms          #Same additions, in the same order, as matchjds
+  err = a - (b + offset)
+  ok = numpy.absolute(err) < 2e-4
+  last = len(matchoffsets) - 1 - ok[:,::-1].argmax(axis=1)     #Last offset that matched
+  found = ok.any(axis=1)
+  clash = (numpy.absolute(a-b) > 1)[:,0]
+
+  for p in range(len(pkeys)):
+    akey,bkey = pkeys[p]
+    matches, clashes = out[pf[p]]
+    if clash[p]:
+      clashes[akey].append(bkey)
+    if found[p]:
+      k = last[p]
+      matches[akey][bkey] = (matchoffsets[k][3], float(err[p,k]))
+  return out
+
+
+class HeaderFields:
+  pass          #An instance of this is used to store the header fields sorted by group.
+
+
+class TimeResult:
+  """The result of analysing the time fields in one FITS header, as returned by
+     findtime when called with result=1. Attributes are:
+
+     time      - the output time (base field plus offsets, as for findtime), or None
+     report    - the analysis text, as returned by findtime with verbose=1
+     warnings  - errors and warnings only, as returned by findtime with verbose=0
+     fields    - HeaderFields object with all the values found in the header
+     hdelta    - heliocentric correction, in days
+     edelta    - half the exposure time, in days
+     jdict     - all the julian days found, including HJD_Calc, keyed by field
+                 name, or None if there's no date/time or JD information
+     printed   - any warnings printed to stdout during the analysis
+
+     and the best value found in the header for exposure time, RA and DEC (in
+     seconds, hours and degrees), the name of the field it came from, and any
+     warning text, eg exptime, exptimefield, exptimecomment.
+  """
+  def __init__(self):
+    self.time = None
+    self.report = ''
+    self.warnings = ''
+    self.fields = None
+    self.hdelta = 0.0
+    self.edelta = 0.0
+    self.jdict = None
+    self.printed = ''
+    self.exptime, self.exptimefield, self.exptimecomment = None, "None", ''
+    self.ra, self.rafield, self.racomment = None, "None", ''
+    self.dec, self.decfield, self.deccomment = None, "None", ''
+
+
+def _todict(r):
+  "Convert a TimeResult into a dictionary of plain values, for storing in a cache"
+  d = r.__dict__.copy()
+  d['fields'] = r.fields.__dict__.copy()
+  return d
+
+
+def _fromdict(d):
+  "Convert a dictionary made by _todict back into a TimeResult"
+  r = TimeResult()
+  r.__dict__.update(d)
+  r.fields = HeaderFields()
+  r.fields.__dict__.update(d['fields'])
+  return r
+
+
+class StageTimer:
+  """Collects the time taken by each stage of processing a batch of files, for
+     the --profile option. Code being timed calls add(stage, seconds) once for
+     each file that goes through that stage, and summary() gives the count,
+     total, mean and 95th percentile time for each stage, in the order the
+     stages were first seen. Anything that takes an optional timer (eg
+     fits.FITS and TimeEngine) skips the timing entirely if it's None, so
+     there is no cost when profiling is turned off.
+  """
+  def __init__(self):
+    self.times = {}
+    self.stages = []
+
+  def add(self, stage, seconds):
+    """Record one run of 'stage', taking 'seconds'."""
+    try:
+      self.times[stage].append(seconds)
+    except KeyError:
+      self.times[stage] = [seconds]
+      self.stages.append(stage)
+
+  def merge(self, other):
+    """Add all the times recorded by another StageTimer (eg from a worker process)."""
+    for stage in other.stages:
+      for t in other.times[stage]:
+        self.add(stage, t)
+
+  def summary(self):
+    """Return a table of the count, total, mean and 95th percentile time for
+       each stage, as a string.
+    """
+    out = "%-12s %8s %10s %10s %10s\n" % ('Stage', 'Count', 'Total(s)', 'Mean(ms)', 'P95(ms)')
+    for stage in self.stages:
+      tl = self.times[stage][:]
+      tl.sort()
+      total = sum(tl)
+      p95 = tl[int(round(0.95*(len(tl)-1)))]
+      out += "%-12s %8d %10.3f %10.3f %10.3f\n" % (stage, len(tl), total,
+                                                    total/len(tl)*1000, p95*1000)
+    return out
+
+
+def findtime(fname='', fimage=None, verbose=1, allfields=0, result=0, timer=None):
+  """Find the time of the observation in FITS file 'fname', or in the FITS
+     object 'fimage' if that is given, using the options in the module variables
+     basefield, hcorr, ecorr, mcorr and parseing.dateorder. See TimeEngine.findtime.
+  """
+  engine = TimeEngine(basefield, hcorr, ecorr, mcorr, parseing.dateorder, timer=timer)
+  return engine.findtime(fname, fimage, verbose, allfields, result)
+
+
+class TimeEngine:
+  """Finds the observation time in FITS headers, using the given options:
+
+     basefield - the julian day field to use for the output time (default HJD_Calc)
+     hcorr     - +1 or -1 to add or subtract the heliocentric correction, or 0
+     ecorr     - +1 or -1 to add or subtract half the exposure time, or 0
+     mcorr     - any extra offset, in days, eg +/- 0.5 for broken JD/MJD conversions
+     dateorder - None, 'DMY' or 'YMD', see parseing.HeaderParser.getdate
+     cache     - a timecache.TimeCache object, or None. If given, the analysis
+                 of each file is stored in the cache, and re-used instead of 
+                 reading the file again if the file hasn't changed.
+     timer     - a StageTimer object, or None. If given, the time taken by
+                 each stage of the analysis is recorded in it.
+     profiles  - an instprofile.ProfileStore object, or None. If given, the
+                 non-verbose analysis learns which header fields are used
+                 for each instrument, and only parses those fields in later
+                 headers from the same instrument.
+     ext       - the extension to read the header from, by number or EXTNAME,
+                 or None for the primary header. See fits.FITS.
+
+     All the state used while analysing one header is kept in local variables
+     and a new parseing.HeaderParser object, so one engine (or many, with 
+     different options) can be used to analyse many headers at once, eg from
+     a pool of threads. The module level findtime function uses an engine
+     created with the options in the module variables.
+  """
+  def __init__(self, basefield='HJD_Calc', hcorr=0, ecorr=0, mcorr=0, dateorder=None,
+               cache=None, timer=None, profiles=None, ext=None):
+    self.basefield = basefield
+    self.hcorr = hcorr
+    self.ecorr = ecorr
+    self.mcorr = mcorr
+    self.dateorder = dateorder
+    self.cache = cache
+    self.timer = timer
+    self.profiles = profiles
+    self.ext = ext
+
+  def close(self):
+    "Close the result cache and the profile store, if there are any."
+    if self.cache:
+      self.cache.close()
+    if self.profiles:
+      self.profiles.close()
+
+  def findtime(self, fname='', fimage=None, verbose=1, allfields=0, result=0):
+    """Find the time of the observation in FITS file 'fname', or in the FITS
+       object 'fimage' if that is given. Returns (time, text), or (time, text,
+       fields) if allfields is true, where text is the full analysis if verbose
+       is true, or just any errors and warnings if not.
+
+       If result is true, the analysis is done (always verbosely) and a
+       TimeResult object is returned instead, holding the time, both versions
+       of the text, and the header values used, from a single pass.
+    """
+    if self.timer:
+      t0 = time.time()
+    verbose = verbose or result
+    usecache = self.cache and fname and not fimage
+    r = None
+    if usecache:
+      key = self._cachekey(fname, verbose)
+      r = self.cache.get(fname, key)
+      if r is not None:
+        r = _fromdict(r)
+        if r.printed:
+          print r.printed,       #Repeat any warnings printed by the original analysis
+    if r is None:
+      r = self._analyse(fname, fimage, verbose)
+      if usecache and r.fields is not None:
+        self.cache.put(fname, key, _todict(r))
+    self._choose(r)
+    if self.timer:
+      self.timer.add('findtime', time.time()-t0)
+    if result:
+      return r
+    if verbose:
+      outstring = r.report
+    else:
+      outstring = r.warnings
+    if allfields:
+      return r.time, outstring, r.fields
+    else:
+      return r.time, outstring
+
+  def findtimes(self, fnames=None, verbose=0):
+    """Find the time of the observation in each of the FITS files in the list
+       fnames, and return a list of TimeResult objects. Nothing is printed, any
+       warnings that findtime would print are in the 'printed' attribute of each
+       result instead. The text returned by findtime is in the 'report' attribute
+       if verbose is true, or the 'warnings' attribute if not.
+
+       For a verbose analysis, the JD fields in all the files are matched against
+       each other in one go, with vmatchjds, instead of one file at a time.
+    """
+    results = []
+    new = []           #Results to add to the cache
+    tomatch = []       #Results needing the JD fields matched
+    for fname in fnames:
+      r = None
+      if self.cache:
+        key = self._cachekey(fname, verbose)
+        r = self.cache.get(fname, key)
+        if r is not None:
+          r = _fromdict(r)
+      if r is None:
+        r = self._analyse(fname, None, verbose, match=0, quiet=1)
+        if verbose and r.jdict is not None:
+          tomatch.append(r)
+        if self.cache and r.fields is not None:
+          new.append((fname, key, r))
+      results.append(r)
+
+    if tomatch:
+      if self.timer:
+        t0 = time.time()
+      mlist = vmatchjds([r.jdict for r in tomatch], [r.hdelta for r in tomatch],
+                        [r.edelta for r in tomatch])
+      for i in range(len(tomatch)):
+        self._addmatches(tomatch[i], mlist[i], quiet=1)
+      if self.timer:
+        self.timer.add('match', time.time()-t0)
+
+    for fname,key,r in new:
+      self.cache.put(fname, key, _todict(r))
+    for r in results:
+      self._choose(r)
+    return results
+
+  def _cachekey(self, fname='', verbose=0):
+    """Return the options that affect the cached analysis of file 'fname'."""
+    if verbose:
+      key = (self.dateorder, verbose, fname)    #The report includes the file name
+    else:
+      key = (self.dateorder, verbose)
+    if self.ext is not None:
+      key = key + (self.ext,)
+    return key
+
+  def _analyse(self, fname='', fimage=None, verbose=1, match=1, quiet=0):
+    """Does the work for findtime, returning a TimeResult object with everything
+       except the output time, which depends on the base field and offset options
+       and is set by _choose. The matching of JD fields against each other is
+       only done if verbose and match are true (findtimes does it separately,
+       for many files at once). If quiet is true, warnings are kept in r.printed
+       instead of being printed.
+    """
+    r = TimeResult()
+    timer = self.timer
+    try:
+      if not fimage:
+        f = fits.FITS(fname,'h',timer=timer,ext=self.ext)
+      else:
+        f = fimage
+
+      if timer:
+        t0 = time.time()
+      headers = f.inherited()      #Includes the primary header cards, for an extension with INHERIT=T
+      yearguess = yearfromheaders(headers)    #Parse other header fields for year to break 2-digit-year degeneracy
+      parser = parseing.HeaderParser(self.dateorder, yearguess, quiet)
+      results = None
+      if self.profiles and not verbose:
+        results = self.profiles.fastparse(parser, headers, f.comments)
+        if results is None:
+          parser = parseing.HeaderParser(self.dateorder, yearguess, quiet)    #No match, start again
+      if results is None:
+        results = parser.parseheader(headers, f.comments)
+        if self.profiles and not verbose:
+          self.profiles.learn(headers, self.dateorder, yearguess, results)
+      hf = HeaderFields()
+      (hf.dates,hf.times,hf.jds,hf.hjds,
+       hf.ras,hf.decs,hf.equinoxes,hf.exptimes, outstring) = results
+      if timer:
+        t1 = time.time()
+        timer.add('parseheader', t1-t0)
+
+      #parseheader returns lists of all values in each category (all dates, all ras, etc). Each list
+      #is composed of tuples, being (value, field, confidence), where value is the number, field is 
+      #a string containing the name of the FITS header field it was derived from, and confidence
+      #is a number from 0 to ~200 containing the 'confidence' that that field is valid'. 
+
+    except (AssertionError, fits.NoSuchHDU):
+      if quiet:
+        r.printed = "#Error opening or parseing FITS headers in file: "+fname+"\n\n"
+      else:
+        print "#Error opening or parseing FITS headers in file: "+fname
+      sys.excepthook(*sys.exc_info())
+      if not quiet:
+        print
+      r.report = r.warnings = "#Error opening or parseing FITS headers in file: "+fname+"\n"
+      return r
+
+    r.fields = hf
+    r.printed = parser.printed
+    warnings = outstring       #Errors and warnings only, the non-verbose output
+
+    if verbose and fname:
+      outstring += "\nFinding time in: "+fname+"\n"
+
+    ftime,ftimefield,os2 = gettime(hf.times, hf.dates, verbose=verbose)
+    fdate,fdatefield,os1 = getdate(hf.dates, verbose=verbose)
+    fjd,fjdfield,os3 = getjd(hf.jds+hf.hjds, verbose=verbose)    
+    fra,frafield,os4 = getra(hf.ras, verbose=verbose)
+    fdec,fdecfield,os5 = getdec(hf.decs, verbose=verbose)
+    fequinox,fequinoxfield,os6 = getequinox(hf.equinoxes, verbose=verbose)
+    fexptime,fexptimefield,os7 = getexptime(hf.exptimes, verbose=verbose)
+    outstring += "".join([os1,os2,os3,os4,os5,os6,os7])
+    warnings += os3 + os7        #The only ones not dependent on verbose
+
+    r.exptime, r.exptimefield, r.exptimecomment = fexptime, fexptimefield, os7
+    r.ra, r.rafield, r.racomment = fra, frafield, os4
+    r.dec, r.decfield, r.deccomment = fdec, fdecfield, os5
+
+    #Above calls extract the 'best' value in each category, by sorting based on confidence. If there is
+    #more than one value for a category, compare the best and second best to check consistency. If there's
+    #no value in a category, make up a reasonable default if appropriate (eg equinox of J2000).
+
+    if fexptime:
+      edelta = (fexptime/2.0)/86400       #Half the exposure time, in days
+    else:
+      if verbose:
+        outstring += "No exposure time information, can't verify or calculate time offsets\n"
+      edelta = 0.0
+
+
+    #Calculate HJD_Calc from the best date and time field, and find the heliocentric offset
+
+    if fdate and ftime:
+      cjd = coords.juldate(data=(fdate[0], fdate[1], int(fdate[2]),
+                                   ftime[0], ftime[1], ftime[2], 0,0,0))
+      chjd = coords.hjd(jd=cjd, ra=fra*15.0, dec=fdec)
+      hdelta = chjd - cjd
+      chjd = chjd + edelta
+      hf.hjds.insert(0,(chjd,"HJD_Calc",200))
+      chjdfield = "(" + fdatefield + " & " + ftimefield + " + Hel.Corr. + Exptime/2)"
+    elif fjd:
+      ghjd = coords.hjd(jd=fjd, ra=fra*15.0, dec=fdec)
+      hdelta = ghjd - fjd
+      chjdfield = None         #No HJD_Calc without a date and time
+    else:
+      if verbose:
+        outstring += "No date and time, or any form of JD field. No idea how to find the time for this image...\n"
+      chjdfield = "(no data)"
+      r.report, r.warnings = outstring, warnings
+      return r
+
+    r.hdelta, r.edelta = hdelta, edelta
 
+    if ( (abs(hdelta)<1e-4) or (edelta<1e-4)) and verbose:
+      outstring += "Heliocentric or exptime/2 offset is less than 0.0001 days, can't reliably compare JD offsets\n"
+
+    if verbose:
+      if chjdfield:
+        outstring += "Calculated HJD_Calc from "+chjdfield+"\n"
+      outstring += "Hel.Corr = %8.6f (%6.2f sec)  Exptime/2 = %8.6f (%6.2f sec) \n" % (hdelta,
+                                                                                       hdelta*86400,
+                                                                                       edelta,
+                                                                                       edelta*86400)
+
+    jdict = {}
+    for item in hf.jds + hf.hjds:
+      jdict[item[1]] = item[0]
+
+    if timer:
+      t2 = time.time()
+      timer.add('select', t2-t1)
+
+    r.jdict = jdict
+    r.report, r.warnings = outstring, warnings
+
+    if verbose and match:
+      #Now compare every field containing a JD or HJD value with every other, checking for close matches,
+      #for all possible combinations of heliocentric, half-exptime and half-day offsets.
+      self._addmatches(r, matchjds(jdict, hdelta, edelta), quiet)
+      if timer:
+        timer.add('match', time.time()-t2)
+
+    return r
+
+  def _addmatches(self, r, (matches, clashes), quiet=0):
+    """Add the list of JD fields, and the matches and clashes between them found by
+       matchjds, to the report in TimeResult r. Warnings about clashes are printed
+       (unless quiet is true) and added to r.printed as well.
+    """
+    jdict = r.jdict
+    jlist = jdict.keys()
+    jlist.sort()
+    outstring = r.report
+    for akey in jlist:
+      outstring += akey + " = " + `jdict[akey]` + '\n'
+      for bkey in matches[akey].keys():
+        outstring += " "*len(akey) + " = " + bkey + (matches[akey][bkey][0] + 
+                     "   (" + str(round(matches[akey][bkey][1]*86400,2)) +" sec error)\n" )
+
+    for akey in jlist:
+      for bkey in clashes[akey]:
+        outstring += "Warning: %s=%9.5f and %s=%9.5s differ by more than one day!" % (akey, jdict[akey], bkey, jdict[bkey])
+        if not quiet:
+          print "Warning: %s=%9.5f and %s=%9.5s differ by more than one day!" % (akey, jdict[akey], bkey, jdict[bkey])
+        r.printed += "Warning: %s=%9.5f and %s=%9.5s differ by more than one day!\n" % (akey, jdict[akey], bkey, jdict[bkey])
+    r.report = outstring
+
+  def _choose(self, r):
+    """Set the output time in TimeResult r, from the base field and offsets given
+       by the engine options, and return r.
+    """
+    if r.jdict is None:      #No time information found at all
+      return r
+    try:
+      out = r.jdict[self.basefield]
+    except KeyError:         #The base field isn't available
+      r.report = r.report + "Invalid base field specified\n"
+      r.warnings = r.warnings + "Invalid base field specified\n"
+      return r
+    r.time = out + self.hcorr*r.hdelta + self.ecorr*r.edelta + self.mcorr
+    return r
+
+
+def _process(f, verbose=0, engine=None):
+  """Find the time in file 'f', and print the result exactly as the command line
+     program does - either the file name and time, or the full analysis if
+     verbose is true. Uses the given TimeEngine, or the module level options.
+  """
+  if verbose:
+    print '\n',f,
+  else:
+    print f,
+  if engine:
+    t,comments=engine.findtime(fname=f,verbose=verbose)
+  else:
+    t,comments=findtime(fname=f,verbose=verbose)
+  if t:
+    print comments,t
+    return t
+  else:
+    print "***No Data***"
+    return None
+
+
+def _processbatch(files, verbose=0, engine=None):
+  """Find the times in a list of files with engine.findtimes, and print the
+     results exactly as _process would for each file. If there's an error, the
+     files are done again one at a time with _process, so that the output up to
+     the file with the error is the same too.
+  """
+  try:
+    results = engine.findtimes(files, verbose)
+  except Exception:
+    for f in files:
+      _process(f, verbose, engine)
+    return
+  for i in range(len(files)):
+    f, r = files[i], results[i]
+    if verbose:
+      print '\n',f,
+      comments = r.report
+    else:
+      print f,
+      comments = r.warnings
+    if r.printed:
+      print r.printed,
+    if r.time:
+      print comments,r.time
+    else:
+      print "***No Data***"
+
+
+_engine = None       #The TimeEngine used by _runjob, set by _initworker
+
+
+def _initworker(engine=None):
+  """Set the engine used by _runjob for every file. Used as the initializer
+     for each worker process, so the engine (and its cache and profiles) is
+     only set up once per process, and closed when the process exits.
+  """
+  global _engine
+  _engine = engine
+  if engine:
+    import multiprocessing.util
+    multiprocessing.util.Finalize(None, engine.close, exitpriority=10)
+
+
+def _runjob(job):
+  """Run _process for one file (eg in a worker process), with the engine set
+     by _initworker, and return the time found (or None), the output as a
+     string, and a StageTimer with the times for this file if the engine has a
+     timer (or None), so that the parent can print the results in the original
+     order, or sorted by time, and add up the times. Any exception is reported
+     in the output instead of being raised.
+  """
+  f, verbose = job
+  engine = _engine
+  timer = None
+  if engine and engine.timer:
+    engine = copy.copy(engine)     #Keep the times for this file separate, to pass back
+    engine.timer = timer = StageTimer()
+  stdout = sys.stdout
+  sys.stdout = StringIO()
+  t = None
   try:
-    out = jdict[basefield]
-  except KeyError:         #The base field isn't available
-    return None, outstring + "Invalid base field specified\n"
-  out = out + hcorr*hdelta + ecorr*edelta + mcorr
-  if allfields:
-    return out, outstring, hf
+    try:
+      t = _process(f, verbose, engine)
+    except Exception:
+      print "\n#Error processing file: " + f
+      traceback.print_exc(file=sys.stdout)
+    return t, sys.stdout.getvalue(), timer
+  finally:
+    sys.stdout = stdout
+
+
+def _collect(results, timer=None):
+  """Yield (time, output) for each of the results from _runjob, adding the
+     stage times for each file to timer, if given.
+  """
+  for t,out,jtimer in results:
+    if timer and jtimer:
+      timer.merge(jtimer)
+    yield t,out
+
+
+def _readrun(f):
+  """Yield the records written to temporary file f by extsort."""
+  f.seek(0)
+  while 1:
+    try:
+      yield marshal.load(f)
+    except EOFError:
+      f.close()
+      return
+
+
+def extsort(records, runsize=None):
+  """Yield the items from the iterable 'records' in sorted order, without
+     holding more than 'runsize' (default sortrunsize) of them in memory at
+     once. Each run of that many items is sorted and written to a temporary
+     file, and the runs are then merged. The items must be values that the
+     marshal module can store, eg tuples of numbers and strings.
+  """
+  if not runsize:
+    runsize = sortrunsize
+  runs = []
+  records = iter(records)
+  while 1:
+    run = list(itertools.islice(records, runsize))
+    run.sort()
+    if len(run) < runsize and not runs:
+      for r in run:            #Everything fitted in memory, no need to merge
+        yield r
+      return
+    if run:
+      f = tempfile.TemporaryFile()
+      for r in run:
+        marshal.dump(r, f)
+      runs.append(f)
+    if len(run) < runsize:
+      break
+  del run
+  for r in heapq.merge(*[_readrun(f) for f in runs]):
+    yield r
+
+
+def _readnames(fname='-'):
+  """Yield the file names listed one per line in file 'fname', or on standard
+     input if fname is '-', ignoring blank lines.
+  """
+  if fname == '-':
+    f = sys.stdin
   else:
-    return out, outstring
+    f = open(fname, 'r')
+  for line in f:
+    line = line.strip()
+    if line:
+      yield line
+
+
+
+def _expand(files=None):
+  """Yield the file names in 'files', with any tar or zip archive replaced by
+     the members of it matching fitspatterns, in archive order, as
+     'archive::member' names.
+  """
+  for f in files:
+    if fits.isarchive(f):
+      for m in fits.archivemembers(f):
+        for p in fitspatterns:
+          if fnmatch.fnmatch(fits.splitmember(m)[1], p):
+            yield m
+            break
+    else:
+      yield f
+
+
+def watch(dirname='.', verbose=0, engine=None, donefile=None, patterns=None):
+  """Watch directory 'dirname' for new files matching any of the shell-style
+     patterns given (default *.fits, *.fit and *.fts), and run _process on
+     each one as soon as fits.headercomplete says its header has all been
+     written, flushing the output after each file. Never returns.
+
+     The names of files processed are appended to 'donefile', if given, and
+     any names already in it are skipped, so a restarted watch doesn't
+     repeat them. Names are compared (and written) as absolute paths, so
+     the same file given as 'dir/x.fits' and './dir/x.fits' is only done
+     once. Files found with an incomplete header are only checked again
+     once their size or modification time has changed.
+  """
+  if not patterns:
+    patterns = fitspatterns
+  done = {}
+  df = None
+  if donefile:
+    if os.path.exists(donefile):
+      for line in open(donefile):
+        done[os.path.abspath(line.rstrip('\n'))] = 1
+    df = open(donefile, 'a')
+  waiting = {}          #(size,mtime) of each file when its header was last found incomplete
+  while 1:
+    names = os.listdir(dirname)
+    names.sort()
+    for n in names:
+      fname = os.path.join(dirname, n)
+      path = os.path.abspath(fname)
+      if done.has_key(path):
+        continue
+      for p in patterns:
+        if fnmatch.fnmatch(n, p):
+          break
+      else:
+        continue
+      try:
+        st = os.stat(fname)
+      except OSError:
+        continue            #Deleted or renamed since the listdir
+      sig = (st.st_size, st.st_mtime)
+      if waiting.get(path) == sig:
+        continue
+      if not fits.headercomplete(fname):
+        waiting[path] = sig
+        continue
+      if waiting.has_key(path):
+        del waiting[path]
+      try:
+        _process(fname, verbose, engine)
+      except Exception:
+        print "\n#Error processing file: " + fname
+        traceback.print_exc(file=sys.stdout)
+      sys.stdout.flush()
+      done[path] = 1
+      if df:
+        df.write(path + '\n')
+        df.flush()
+    time.sleep(pollinterval)
 
 
 
@@ -392,7 +1078,17 @@ if __name__ == '__main__':
   signs={'-':-1, '+':+1}
 
   files=[]
-  for ar in args:
+  njobs=1       #Number of worker processes
+  cache=None    #Result cache, if any
+  watchdir=None #Directory to watch for new files, if any
+  donefile=None #List of files already done in watch mode
+  dosort=0      #Print the results in time order
+  fromfile=None #File containing a list of file names to process
+  timer=None    #Stage timer for --profile
+  profiles=None #Learned instrument profiles, if any
+  ext=None      #Extension to read the headers from, if not the primary HDU
+  argi=iter(args)
+  for ar in argi:
     if ar=='-s' or ar=='-S' or ar=='-show' or ar=='--show':
       verbose=1
     elif ar=='-h' or ar=='-help' or ar=='--help':
@@ -402,6 +1098,33 @@ if __name__ == '__main__':
       parseing.dateorder='DMY'
     elif ar=='-YMD' or ar=='-ymd' or ar=='--YMD' or ar=='--ymd':
       parseing.dateorder='YMD'
+    elif ar[:8]=='--cache=':
+      import timecache
+      cache=timecache.TimeCache(ar[8:])
+    elif ar[:8]=='--learn=':
+      import instprofile
+      profiles=instprofile.ProfileStore(ar[8:])
+    elif ar[:6]=='--ext=':
+      ext=ar[6:]
+      if ext.isdigit():
+        ext=int(ext)
+      elif not ext:
+        sys.exit("Invalid option '--ext=', must specify an extension number or name")
+    elif ar=='--profile':
+      timer=StageTimer()
+    elif ar=='--sort':
+      dosort=1
+    elif ar[:7]=='--from=':
+      fromfile=ar[7:]
+    elif ar[:8]=='--watch=':
+      watchdir=ar[8:]
+    elif ar[:7]=='--done=':
+      donefile=ar[7:]
+    elif ar[:2]=='-j':
+      try:
+        njobs=int(ar[2:] or argi.next())
+      except (ValueError, StopIteration):
+        sys.exit("Invalid option '-j', must specify a number of worker processes")
     elif ar[0]=='=':
       ac=ar[1:]
       if not ac:
@@ -432,14 +1155,53 @@ if __name__ == '__main__':
     else:
       files.append(ar)
 
-  for f in files:
-    if verbose:
-      print '\n',f,
-    else:
-      print f,
-    t,comments=findtime(fname=f,verbose=verbose)
-    if t:
-      print comments,t
+  engine = TimeEngine(basefield, hcorr, ecorr, mcorr, parseing.dateorder, cache, timer, profiles, ext)
+
+  if watchdir:
+    if not donefile:
+      donefile = os.path.join(watchdir, '.fitstime-done')
+    try:
+      watch(watchdir, verbose, engine, donefile, files)
+    except KeyboardInterrupt:
+      pass
+  else:
+    if fromfile:
+      files = itertools.chain(files, _readnames(fromfile))
+    files = _expand(files)
+    jobs = ((f,verbose) for f in files)
+    if njobs > 1:
+      import multiprocessing
+      pool = multiprocessing.Pool(njobs, _initworker, (engine,))
+      results = _collect(pool.imap(_runjob, jobs, 4), timer)    #Results come back in the original file order
+    elif dosort:
+      _engine = engine
+      results = _collect(itertools.imap(_runjob, jobs), timer)
+    elif verbose and coords.Gotnumpy:
+      results = None
+      files = iter(files)
+      while 1:          #Match the JD fields for a batch of files at a time
+        batch = list(itertools.islice(files, batchsize))
+        if not batch:
+          break
+        _processbatch(batch, verbose, engine)
     else:
-      print "***No Data***"
+      results = None
+      for f in files:
+        _process(f, verbose, engine)
+
+    if dosort:
+      #Sort on time, with files that have no time last, then on the original order
+      records = ((t is None, t, i, out) for i,(t,out) in enumerate(results))
+      for r in extsort(records):
+        sys.stdout.write(r[3])
+    elif results is not None:
+      for t,out in results:
+        sys.stdout.write(out)
+    if njobs > 1:
+      pool.close()
+      pool.join()
+
+  engine.close()
+  if timer:
+    sys.stderr.write(timer.summary())
   
@@ -0,0 +1,253 @@
+
+"""Learned per-instrument header profiles, for a fast path through the time
+   analysis.
+
+   Every frame from one telescope and instrument usually has the same header
+   layout, so the same fields win in each category every time. A profile,
+   keyed by the TELESCOP, OBSERVAT and INSTRUME values (and the date order
+   option), records which keytable fields gave the best date, time, RA, DEC
+   and exposure time in a frame analysed in full. Later frames with the same
+   signature only have those fields parsed (plus all the JD fields, and any
+   others in keytable that could possibly beat the winners), instead of the
+   whole of keytable. If the parsed fields don't give the same winners with
+   the same confidence, the frame is analysed in full and the profile is
+   learned again from it.
+
+   Warnings from fields that the profile skips aren't produced, so profiles
+   are only used for the non-verbose analysis (ie the plain time list).
+
+   Profiles are stored in an SQLite file. Use as:
+
+   import instprofile, fitstime
+   engine = fitstime.TimeEngine(profiles=instprofile.ProfileStore('/path/profiles.db'))
+
+   Written by Andrew Williams, Perth Observatory
+   <andrew@physics.uwa.edu.au>
+"""
+
+version = "$Revision$"
+
+import threading
+import cPickle
+import sqlite3
+
+import parseing
+
+
+sigkeys = ['TELESCOP', 'OBSERVAT', 'INSTRUME']     #Header cards identifying an instrument
+
+categories = ['dates', 'times', 'ras', 'decs', 'exptimes']   #Best value used for the output time
+
+#For each keytable handler, the categories it can add a value to, and which column of
+#keytable ('conf' or 'extra', or both) gives the highest confidence it can give that value.
+#A field that can't beat a profile's winner in any category doesn't need to be parsed.
+_feeds = {'date':[('dates','conf'), ('times','extra')],
+          'dateT':[('dates','conf'), ('times','extra')],
+          'epoch':[('dates','conf'), ('times','extra')],
+          'time':[('times','conf')],
+          'timeT':[('times','conf')],
+          'jd':[],
+          'hjd':[],
+          'ra':[('ras','conf'), ('ras','extra')],
+          'dec':[('decs','conf')],
+          'equinox':[],
+          'exptime':[('exptimes','conf')]}
+
+_yearsetters = ['date', 'dateT', 'epoch']     #Handlers that call getdate, which may set yearguess
+
+
+def signature(h=None, dateorder=None):
+  """Return the profile signature for header dictionary h, or None if it has
+     none of the cards in sigkeys.
+  """
+  sig = (h.get(sigkeys[0]), h.get(sigkeys[1]), h.get(sigkeys[2]), dateorder)
+  if sig[0] is None and sig[1] is None and sig[2] is None:
+    return None
+  return sig
+
+
+def _best(values):
+  """Return the (field, confidence) of the value that the getters in fitstime would
+     choose from the list, or None if it's empty.
+  """
+  if not values:
+    return None
+  best = values[0]
+  for v in values[1:]:
+    if v[2] > best[2]:       #Earliest wins when confidences are equal, as with a stable sort
+      best = v
+  return best[1], best[2]
+
+
+def _row(field):
+  """Return the index of the keytable entry that produced a value with the given field
+     name (the key, plus a lower case suffix for some handlers).
+  """
+  key = field.rstrip('abcdefghijklmnopqrstuvwxyz')
+  suffix = field[len(key):]
+  for i in range(len(parseing.keytable)):
+    k,ftype,handler,conf,extra = parseing.keytable[i]
+    if k == key and ((suffix == 't') == (handler == 'timeT')):
+      return i
+  raise KeyError(field)
+
+
+def learn(yearguess=None, results=None):
+  """Build a profile given the initial yearguess passed to the HeaderParser, and
+     the lists returned by its parseheader for a header.
+  """
+  dates,times,jds,hjds,ras,decs,equinoxes,exptimes,output = results
+  lists = {'dates':dates, 'times':times, 'ras':ras, 'decs':decs, 'exptimes':exptimes}
+  rows = range(len(parseing.keytable))
+  winners = {}
+  use = {}
+  for cat in categories:
+    winners[cat] = _best(lists[cat])
+    if winners[cat]:
+      use[_row(winners[cat][0])] = 1
+
+  for i in rows:
+    key,ftype,handler,conf,extra = parseing.keytable[i]
+    if handler == 'jd' or handler == 'hjd':
+      use[i] = 1           #The time can come from any JD field, depending on the options
+      continue
+    for cat,col in _feeds[handler]:
+      if col == 'conf':
+        bound = conf
+      else:
+        bound = extra
+      w = winners[cat]
+      if (w is None) or (bound > w[1]) or (bound == w[1] and i < _row(w[0])):
+        use[i] = 1         #This field might win, if it's in the header
+
+  if yearguess is None and use:
+    last = max(use.keys())
+    for i in rows:          #Any date before the last field used might set the year guess
+      if i < last and parseing.keytable[i][2] in _yearsetters:
+        use[i] = 1
+
+  use = use.keys()
+  use.sort()
+  return {'use':tuple(use), 'winners':winners, 'noyear':(yearguess is None)}
+
+
+def check(profile=None, parser=None, h=None, comments=None, table=None):
+  """Parse header dictionary h using only the fields in the profile, with the
+     given (new) HeaderParser, and return the same lists as parseheader does.
+     Returns None if the header doesn't match the profile, or the fields used
+     don't give the same winners, in which case the header must be analysed in
+     full, with a new HeaderParser. If given, table is the dispatch list for the
+     fields in the profile, from parseing.subtable.
+  """
+  if (parser.yearguess is None) <> profile['noyear']:
+    return None
+  if table is None:
+    table = parseing.subtable(profile['use'])
+  try:
+    results = parser.parseheader(h, comments, table)
+  except AssertionError:
+    return None
+  dates,times,jds,hjds,ras,decs,equinoxes,exptimes,output = results
+  lists = {'dates':dates, 'times':times, 'ras':ras, 'decs':decs, 'exptimes':exptimes}
+  for cat in categories:
+    if _best(lists[cat]) <> profile['winners'][cat]:
+      return None
+  return results
+
+
+class ProfileStore:
+  """A persistent set of profiles, keyed by signature. Profiles are loaded from
+     the file as they are needed, and written to it as they are learned. A
+     ProfileStore can be shared between threads, and pickled to send it to
+     worker processes (each process opens its own connection to the file).
+     Only the file name is pickled, so a worker should keep the store it is
+     given for all its files, as fitstime does with -j, rather than getting
+     a new copy with each job.
+  """
+  def __init__(self, filename=''):
+    self.filename = filename
+    self.db = None
+    self.profiles = {}
+    self.tables = {}        #Dispatch list for the fields in each profile
+    self.lock = threading.Lock()
+
+  def __getstate__(self):
+    return {'filename':self.filename}
+
+  def __setstate__(self, state):
+    self.__init__(state['filename'])
+
+  def _connect(self):
+    if self.db is None:
+      self.db = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+      self.db.text_factory = str
+      self.db.execute("""CREATE TABLE IF NOT EXISTS profiles (
+                           signature TEXT PRIMARY KEY, profile BLOB)""")
+      self.db.commit()
+    return self.db
+
+  def get(self, sig=''):
+    """Return the profile for signature 'sig', or None if there isn't one."""
+    try:
+      return self.profiles[sig]
+    except KeyError:
+      pass
+    self.lock.acquire()
+    try:
+      if not self.profiles.has_key(sig):
+        row = self._connect().execute("SELECT profile FROM profiles WHERE signature=?",
+                                      (repr(sig),)).fetchone()
+        if row is None:
+          self.profiles[sig] = None
+        else:
+          profile = cPickle.loads(str(row[0]))
+          self.tables[sig] = parseing.subtable(profile['use'])
+          self.profiles[sig] = profile
+      return self.profiles[sig]
+    finally:
+      self.lock.release()
+
+  def put(self, sig='', profile=None):
+    """Store the profile for signature 'sig', replacing any previous one."""
+    self.lock.acquire()
+    try:
+      self.tables[sig] = parseing.subtable(profile['use'])
+      self.profiles[sig] = profile
+      db = self._connect()
+      db.execute("INSERT OR REPLACE INTO profiles VALUES (?,?)",
+                 (repr(sig), sqlite3.Binary(cPickle.dumps(profile, 2))))
+      db.commit()
+    finally:
+      self.lock.release()
+
+  def fastparse(self, parser=None, h=None, comments=None):
+    """Parse header dictionary h with the given (new) HeaderParser, using only
+       the fields in the matching profile, and return the same lists as
+       parser.parseheader. Returns None if there is no matching profile, or the
+       header doesn't match it, in which case the header must be parsed in full
+       with a new HeaderParser, and the results passed to learn().
+    """
+    sig = signature(h, parser.dateorder)
+    if sig is None:
+      return None
+    profile = self.get(sig)
+    if profile is None:
+      return None
+    return check(profile, parser, h, comments, self.tables[sig])
+
+  def learn(self, h=None, dateorder=None, yearguess=None, results=None):
+    """Learn the profile for header dictionary h, given the date order and initial
+       year guess of the HeaderParser used, and the lists returned by its
+       parseheader, replacing any existing profile for the same signature.
+    """
+    sig = signature(h, dateorder)
+    if sig is None:
+      return
+    profile = learn(yearguess, results)
+    if profile <> self.get(sig):
+      self.put(sig, profile)
+
+  def close(self):
+    if self.db is not None:
+      self.db.close()
+      self.db = None
@@ -0,0 +1,203 @@
+#!/usr/bin/python
+
+"""Build the Chebyshev ephemeris file used by coords.bjd and coords.vbjd.
+
+   The position of the Earth relative to the solar system barycentre is worked
+   out from the Keplerian elements of the planets and the Earth-Moon barycentre
+   (E.M. Standish, 'Keplerian Elements for Approximate Positions of the Major
+   Planets', JPL, table 1, valid 1800-2050), plus the offset of the Sun from the
+   barycentre due to the planets, and the offset of the Earth from the Earth-Moon
+   barycentre due to the Moon (using the low precision lunar position from the
+   Astronomical Almanac). This agrees with the reference positions in
+   coords.ephemrefs (2005 to 2013) to about 1e-4 AU, ie about 0.05 seconds in
+   the light travel time.
+
+   The positions, in AU on the J2000 equatorial axes, are fitted with Chebyshev
+   polynomials over fixed length segments, and written as a small binary file,
+   with the header:
+
+     8 bytes   'CHEBEPH1'
+     double    JD of the start of the first segment
+     double    segment length, in days
+     int       number of segments
+     int       number of coefficients per coordinate
+
+   followed by the coefficients (segment, then x/y/z, then order), all numbers
+   big-endian. The file only needs to be built again to change the range or
+   resolution. Needs numpy.
+
+   usage:  mkephem [filename]      (default earth.eph, next to coords.py)
+
+   The new file is written under a temporary name, and checked with
+   coords.checkephem against the reference positions in coords.ephemrefs. If
+   it differs by more than coords.ephemtolerance, it's deleted and an error is
+   raised, leaving any old file in place. Otherwise it's renamed to filename.
+
+   Written by Andrew Williams, Perth Observatory
+   <andrew@physics.uwa.edu.au>
+"""
+
+version = "$Revision$"
+
+import os
+import sys
+import struct
+import numpy
+
+import coords
+
+jdstart = 2444239.5      #1980 January 1.0
+jdend = 2469807.5        #2050 January 1.0
+seglen = 32.0            #Days per segment
+ncoef = 11               #Chebyshev coefficients per coordinate per segment
+
+obliquity = 23.43928     #Of the J2000 ecliptic, degrees
+
+#Keplerian elements and rates per century, J2000 ecliptic and equinox:
+#a (AU), e, I, L, longitude of perihelion, longitude of node (degrees), and
+#the mass of each body, as a fraction of the Sun's.
+elements = [
+  ('Mercury', (0.38709927, 0.20563593, 7.00497902, 252.25032350, 77.45779628, 48.33076593),
+              (0.00000037, 0.00001906, -0.00594749, 149472.67411175, 0.16047689, -0.12534081),
+              1.0/6023600.0),
+  ('Venus',   (0.72333566, 0.00677672, 3.39467605, 181.97909950, 131.60246718, 76.67984255),
+              (0.00000390, -0.00004107, -0.00078890, 58517.81538729, 0.00268329, -0.27769418),
+              1.0/408523.71),
+  ('EMBary',  (1.00000261, 0.01671123, -0.00001531, 100.46457166, 102.93768193, 0.0),
+              (0.00000562, -0.00004392, -0.01294668, 35999.37244981, 0.32327364, 0.0),
+              1.0/328900.56),
+  ('Mars',    (1.52371034, 0.09339410, 1.84969142, -4.55343205, -23.94362959, 49.55953891),
+              (0.00001847, 0.00007882, -0.00813131, 19140.30268499, 0.44441088, -0.29257343),
+              1.0/3098708.0),
+  ('Jupiter', (5.20288700, 0.04838624, 1.30439695, 34.39644051, 14.72847983, 100.47390909),
+              (-0.00011607, -0.00013253, -0.00183714, 3034.74612775, 0.21252668, 0.20469106),
+              1.0/1047.3486),
+  ('Saturn',  (9.53667594, 0.05386179, 2.48599187, 49.95424423, 92.59887831, 113.66242448),
+              (-0.00125060, -0.00050991, 0.00193609, 1222.49362201, -0.41897216, -0.28867794),
+              1.0/3497.898),
+  ('Uranus',  (19.18916464, 0.04725744, 0.77263783, 313.23810451, 170.95427630, 74.01692503),
+              (-0.00196176, -0.00004397, -0.00242939, 428.48202785, 0.40805281, 0.04240589),
+              1.0/22902.98),
+  ('Neptune', (30.06992276, 0.00859048, 1.77004347, -55.12002969, 44.96476227, 131.78422574),
+              (0.00026291, 0.00005105, 0.00035372, 218.45945325, -0.32241464, -0.00508664),
+              1.0/19412.24)]
+
+moonfraction = 1.0/82.300570     #Moon's mass, as a fraction of the Earth+Moon
+earthradius = 6378.14/149597870.7     #AU
+
+
+def _sin(x):
+  return numpy.sin(numpy.radians(x))
+
+def _cos(x):
+  return numpy.cos(numpy.radians(x))
+
+
+def toequatorial(x, y, z):
+  """Rotate J2000 ecliptic coordinates to J2000 equatorial."""
+  return (x, _cos(obliquity)*y - _sin(obliquity)*z, _sin(obliquity)*y + _cos(obliquity)*z)
+
+
+def heliocentric(body, T):
+  """Return the heliocentric ecliptic (x,y,z) of the body (an entry in elements)
+     in AU, for an array of T, Julian centuries after J2000.
+  """
+  name, el, rates, mass = body
+  a, e, I, L, peri, node = [el[i] + rates[i]*T for i in range(6)]
+  M = numpy.radians(L - peri)
+  M = numpy.arctan2(numpy.sin(M), numpy.cos(M))
+  E = M + e*numpy.sin(M)
+  for i in range(20):         #Newton's method for Kepler's equation
+    E = E - (E - e*numpy.sin(E) - M)/(1.0 - e*numpy.cos(E))
+  xp = a*(numpy.cos(E) - e)
+  yp = a*numpy.sqrt(1.0 - e*e)*numpy.sin(E)
+  w = peri - node
+  x = (_cos(w)*_cos(node) - _sin(w)*_sin(node)*_cos(I))*xp + (-_sin(w)*_cos(node) - _cos(w)*_sin(node)*_cos(I))*yp
+  y = (_cos(w)*_sin(node) + _sin(w)*_cos(node)*_cos(I))*xp + (-_sin(w)*_sin(node) + _cos(w)*_cos(node)*_cos(I))*yp
+  z = _sin(w)*_sin(I)*xp + _cos(w)*_sin(I)*yp
+  return x, y, z
+
+
+def moon(T):
+  """Return the geocentric ecliptic (x,y,z) of the Moon in AU, referred to the
+     J2000 equinox, for an array of T, Julian centuries after J2000.
+  """
+  lon = (218.32 + 481267.881*T + 6.29*_sin(135.0 + 477198.87*T) - 1.27*_sin(259.3 - 413335.36*T)
+         + 0.66*_sin(235.7 + 890534.22*T) + 0.21*_sin(269.9 + 954397.74*T)
+         - 0.19*_sin(357.5 + 35999.05*T) - 0.11*_sin(186.5 + 966404.03*T))
+  lon = lon - 1.396971*T      #Equinox of date to J2000
+  lat = (5.13*_sin(93.3 + 483202.02*T) + 0.28*_sin(228.2 + 960400.89*T)
+         - 0.28*_sin(318.3 + 6003.15*T) - 0.17*_sin(217.6 - 407332.21*T))
+  plx = (0.9508 + 0.0518*_cos(135.0 + 477198.87*T) + 0.0095*_cos(259.3 - 413335.36*T)
+         + 0.0078*_cos(235.7 + 890534.22*T) + 0.0028*_cos(269.9 + 954397.74*T))
+  r = earthradius/_sin(plx)
+  return r*_cos(lat)*_cos(lon), r*_cos(lat)*_sin(lon), r*_sin(lat)
+
+
+def earth(jd):
+  """Return the barycentric equatorial (x,y,z) of the Earth in AU, for an array
+     of JD, from the model.
+  """
+  T = (numpy.asarray(jd, numpy.float64) - 2451545.0)/36525.0
+  sx, sy, sz = 0.0, 0.0, 0.0
+  total = 1.0
+  for body in elements:
+    x, y, z = heliocentric(body, T)
+    sx, sy, sz = sx + body[3]*x, sy + body[3]*y, sz + body[3]*z
+    total = total + body[3]
+    if body[0] == 'EMBary':
+      ex, ey, ez = x, y, z
+  mx, my, mz = moon(T)
+  x = ex - sx/total - moonfraction*mx     #Sun's offset from the barycentre, and
+  y = ey - sy/total - moonfraction*my     #Earth's from the Earth-Moon barycentre
+  z = ez - sz/total - moonfraction*mz
+  return toequatorial(x, y, z)
+
+
+def fit(jd0, length, n):
+  """Return the Chebyshev coefficients, an array of shape (3,n), for the model
+     over the segment from jd0 to jd0+length.
+  """
+  k = numpy.arange(n)
+  u = numpy.cos(numpy.pi*(k + 0.5)/n)            #Chebyshev nodes on -1..1
+  pos = numpy.array(earth(jd0 + (u + 1.0)*length/2.0))
+  Tk = numpy.cos(numpy.outer(k, numpy.pi*(k + 0.5)/n))
+  c = 2.0/n*numpy.dot(pos, Tk.T)
+  c[:,0] = c[:,0]/2.0
+  return c
+
+
+def build(fname):
+  nseg = int(numpy.ceil((jdend - jdstart)/seglen))
+  coefs = numpy.array([fit(jdstart + i*seglen, seglen, ncoef) for i in range(nseg)])
+  tmpname = fname + '.tmp'
+  f = open(tmpname, 'wb')
+  f.write(struct.pack('>8sddii', 'CHEBEPH1', jdstart, seglen, nseg, ncoef))
+  f.write(coefs.astype('>f8').tostring())
+  f.close()
+
+  oldfile = coords.ephemfile
+  coords.ephemfile = tmpname     #Check the new file before replacing the old one
+  try:
+    worst = coords.checkephem()
+    jd = numpy.linspace(jdstart, jdstart + nseg*seglen - 1e-6, 200001)
+    err = numpy.sqrt(sum([(a - b)**2 for a,b in zip(coords.vearthpos(jd), earth(jd))])).max()
+  except:
+    os.remove(tmpname)
+    coords.ephemfile = oldfile
+    coords._ephem = None
+    raise
+  os.rename(tmpname, fname)
+  coords.ephemfile = fname
+  coords._ephem = None
+  print "Wrote %s, %d segments of %g days, %d coefficients, %d bytes" % (fname, nseg, seglen,
+                                                                          ncoef, os.path.getsize(fname))
+  print "Largest difference from the model: %.3g AU (%.3g seconds of light time)" % (err, err*499.004784)
+  print "Largest difference from coords.ephemrefs: %.3g AU (%.3g seconds of light time)" % (worst, worst*499.004784)
+
+
+if __name__ == '__main__':
+  if len(sys.argv) > 1:
+    build(sys.argv[1])
+  else:
+    build(coords.ephemfile)
@@ -0,0 +1,131 @@
+
+"""Persistent cache of FITS header analysis results, stored in an SQLite file.
+
+   Each result is stored with the path, size and modification time of the file
+   it came from, and an MD5 hash of the file's header blocks. If the size and
+   modification time of a file haven't changed, the cached result is used
+   without opening the file at all. If they have changed, but the header
+   blocks are the same (eg the file was copied, or only the data changed),
+   the cached result is still used. Otherwise the entry is replaced when the
+   file is analysed again. For a member of an archive ('archive::member'), the
+   size and modification time of the archive are used.
+
+   Use as:
+
+   import timecache, fitstime
+   engine = fitstime.TimeEngine(cache=timecache.TimeCache('/path/times.db'))
+
+   Written by Andrew Williams, Perth Observatory
+   <andrew@physics.uwa.edu.au>
+"""
+
+version = "$Revision$"
+
+import os
+import threading
+import cPickle
+import sqlite3
+from hashlib import md5
+
+import fits
+
+
+def headerhash(fname=''):
+  """Return the MD5 hex digest of the header blocks of a FITS file, from the
+     start of the file to the end of the block containing the END card. The
+     header of a compressed file is hashed after decompressing it.
+  """
+  f = fits.openfile(fname)
+  h = md5()
+  try:
+    while 1:
+      block = f.read(2880)
+      h.update(block)
+      if len(block) < 2880:
+        break
+      for i in xrange(0, 2880, 80):
+        if block[i:i+8] == 'END     ':
+          return h.hexdigest()
+  finally:
+    f.close()
+  return h.hexdigest()
+
+
+class TimeCache:
+  """A persistent cache of analysis results, keyed by file name and an 'options'
+     value (any object with a stable repr(), eg a tuple of the options that
+     affect the result). The results can be any picklable objects.
+
+     A TimeCache can be shared between threads, and pickled to send it to
+     worker processes (each process opens its own connection to the file).
+  """
+  def __init__(self, filename=''):
+    self.filename = filename
+    self.db = None
+    self.lock = threading.Lock()
+
+  def __getstate__(self):
+    return {'filename':self.filename}
+
+  def __setstate__(self, state):
+    self.__init__(state['filename'])
+
+  def _connect(self):
+    if self.db is None:
+      self.db = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+      self.db.text_factory = str
+      self.db.execute("PRAGMA synchronous=OFF")     #It's only a cache
+      self.db.execute("""CREATE TABLE IF NOT EXISTS results (
+                           path TEXT, options TEXT, size INTEGER, mtime REAL,
+                           hhash TEXT, result BLOB, PRIMARY KEY (path, options))""")
+      self.db.commit()
+    return self.db
+
+  def get(self, fname='', options=None):
+    """Return the cached result for file 'fname' and the given options, or None
+       if there isn't one, or the file has changed since it was stored.
+    """
+    path = os.path.abspath(fname)
+    try:
+      st = os.stat(fits.splitmember(fname)[0])
+    except OSError:
+      return None
+    self.lock.acquire()
+    try:
+      db = self._connect()
+      row = db.execute("SELECT size, mtime, hhash, result FROM results WHERE path=? AND options=?",
+                       (path, repr(options))).fetchone()
+      if row is None:
+        return None
+      size, mtime, hhash, result = row
+      if (size <> st.st_size) or (mtime <> st.st_mtime):
+        if hhash <> headerhash(fname):
+          return None         #Header has changed
+        db.execute("UPDATE results SET size=?, mtime=? WHERE path=? AND options=?",
+                   (st.st_size, st.st_mtime, path, repr(options)))
+        db.commit()
+      return cPickle.loads(str(result))
+    finally:
+      self.lock.release()
+
+  def put(self, fname='', options=None, result=None):
+    """Store the result for file 'fname' and the given options, replacing any
+       previous entry.
+    """
+    path = os.path.abspath(fname)
+    st = os.stat(fits.splitmember(fname)[0])
+    hhash = headerhash(fname)
+    data = sqlite3.Binary(cPickle.dumps(result, 2))
+    self.lock.acquire()
+    try:
+      db = self._connect()
+      db.execute("INSERT OR REPLACE INTO results VALUES (?,?,?,?,?,?)",
+                 (path, repr(options), st.st_size, st.st_mtime, hhash, data))
+      db.commit()
+    finally:
+      self.lock.release()
+
+  def close(self):
+    if self.db is not None:
+      self.db.close()
+      self.db = None